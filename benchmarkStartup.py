@@ -0,0 +1,75 @@
+"""
+Measure the startup time of reserveSandbox.py.
+
+Each path is run in a new Python process several times and the wall clock
+time is reported. The -reserve and -release paths use a temporary sandbox yml
+file that points to a closed local port, so the time measured is the time it
+takes the script to get to its first REST call and fail the connection.
+This shows the cost of interpreter startup, imports, argument parsing and
+loading the yml file without needing a Tokalabs controller.
+
+Requirements
+   - python 3.6+
+   - reserveSandbox.py and sdloAssistant.py in the same directory
+
+Usage:
+   python benchmarkStartup.py
+   python benchmarkStartup.py -repeat 50
+   python benchmarkStartup.py -paths help reserve
+"""
+
+import sys, os, argparse, subprocess, tempfile, time, statistics
+
+currentDir = os.path.dirname(os.path.abspath(__file__))
+reserveScript = os.path.join(currentDir, 'reserveSandbox.py')
+
+# Port 9 (discard) is not expected to be listening so the connection is refused right away.
+sandboxYml = '''sdloControllerIp: 127.0.0.1:9
+user: admin
+password: admin
+sandbox: benchmarkSandbox
+'''
+
+def timeCommand(command, repeat):
+    """
+    Run a command repeat times and return a list of wall clock times in milliseconds
+    """
+    timings = []
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=currentDir)
+        timings.append((time.perf_counter() - startTime) * 1000)
+
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-repeat', type=int, default=20, help='How many times to run each path')
+    parser.add_argument('-paths', nargs='+', default=['help', 'reserve', 'release'],
+                        choices=['help', 'reserve', 'release'], help='The CLI paths to measure')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        ymlFile = os.path.join(tempDir, 'benchmarkSandbox.yml')
+        with open(ymlFile, 'w') as ymlObj:
+            ymlObj.write(sandboxYml)
+
+        commands = {'help':    [sys.executable, reserveScript, '--help'],
+                    'reserve': [sys.executable, reserveScript, '-sandbox', ymlFile, '-reserve'],
+                    'release': [sys.executable, reserveScript, '-sandbox', ymlFile, '-release']}
+
+        # Python interpreter startup alone as a baseline
+        baseline = timeCommand([sys.executable, '-c', 'pass'], args.repeat)
+
+        print('\n{:<10} {:>10} {:>10} {:>10}'.format('path', 'min ms', 'median ms', 'max ms'))
+        print('{:<10} {:>10.1f} {:>10.1f} {:>10.1f}'.format('python', min(baseline), statistics.median(baseline),
+                                                           max(baseline)))
+
+        for path in args.paths:
+            timings = timeCommand(commands[path], args.repeat)
+            print('{:<10} {:>10.1f} {:>10.1f} {:>10.1f}'.format(path, min(timings), statistics.median(timings),
+                                                               max(timings)))
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 """
-This script takes in a yml config file that states which sandbox to use
+This script takes in yml config files that state which sandbox to use
 and the login credentials to the Tokalab controller.
 The yml config file must have these parameters:
 
@@ -13,48 +13,296 @@ Requirements
    - pip install requests PyYAML
    - sdloAssistant.py
    - sandbox yml config file
-    
+
 Usage:
    python reserveSandbox.py -sandbox /path/sandbox.yml -reserve|-release
-   
+
    # -forceTakeOwnership: Include this parameter to force takeover the sandbox if sandbox is already reserve.
    python reserveSandbox.py -sandbox /path/sandbox.yml -reserve -forceTakeOwnership
+
+   # Batch mode: Pass in multiple yml files, directories of yml files or glob patterns.
+   # Sandboxes on the same controller with the same login share one login.
+   # -parallel: How many sandboxes to reserve or release at the same time.
+   # -summary: Also write the JSON summary to a file.
+   python reserveSandbox.py -sandbox /path/sandboxes/ -release -parallel 10
+   python reserveSandbox.py -sandbox '/path/nightly_*.yml' sandbox.yml -reserve -summary summary.json
+
+   # -broker: Send the requests to a running sdloBroker instead of logging into the controller.
+   python reserveSandbox.py -sandbox /path/sandbox.yml -reserve -broker /tmp/sdloBroker.sock
+
+   # -sweep: Release the stale reservations on the controllers of the yml files.
+   # The sandbox parameter in the yml files isn't needed. Filter by:
+   #    -owner: The user that reserved the sandboxes. Defaults to the yml user. 'any' = any user.
+   #    -namePattern: A regex of the sandbox names.
+   #    -sandboxType: regular|child
+   #    -olderThan: Reserved more than this many minutes ago.
+   # -dryRun: Only list the sandboxes that would be released.
+   python reserveSandbox.py -sandbox ciController.yml -sweep -namePattern '^ci-' -olderThan 360 -parallel 8 -dryRun
+
+   # -profile: Run under a profiler. Writes cProfile stats of the main thread to the file and
+   # sampled stacks of all threads in the collapsed stack format to <file>.collapsed for flame graphs.
+   # With -parallel 1 the sandboxes run in the main thread so the cProfile stats show the REST calls.
+   # With more, the work is in the thread pool and only the collapsed stacks show it.
+   python reserveSandbox.py -sandbox /path/sandbox.yml -reserve -profile /tmp/reserve.pstats
+
+   When done, a JSON summary is printed with the outcome, the blueprint child name and
+   the duration of each sandbox. The exit code is 1 if any sandbox failed.
 """
 
-import sys, os, traceback, yaml, argparse
+# yaml and traceback are imported where they are needed to keep the startup time low.
+# sdloAssistant is cheap to import. It logs into the controller on the first request.
+import sys, os, argparse, time
 import sdloAssistant
 
-try:
+def getConfigFiles(paths):
+    """
+    Expand the -sandbox values into a list of yml config files.
+
+    Parameter
+       paths <list>: yml files, directories of yml files or glob patterns
+
+    Return
+       A sorted list of yml files without duplicates
+    """
+    import glob
+
+    configFiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = [os.path.join(path, eachFile) for eachFile in os.listdir(path)
+                       if eachFile.endswith(('.yml', '.yaml'))]
+        elif os.path.exists(path):
+            matches = [path]
+        else:
+            matches = glob.glob(path)
+
+        if not matches:
+            raise Exception(f'No such config file found: {path}')
+
+        configFiles.extend(matches)
+
+    return sorted(set(configFiles))
+
+def groupByController(configFiles, requiredKeys=('sdloControllerIp', 'user', 'password', 'sandbox')):
+    """
+    Read the yml config files and group them by controller and login.
+
+    Return
+       A dict: {(sdloControllerIp, user, password): [(configFile, params), ...]}
+    """
+    import yaml
+
+    groups = {}
+    for configFile in configFiles:
+        with open(configFile) as paramsObj:
+            params = yaml.safe_load(paramsObj)
+
+        for key in requiredKeys:
+            if key not in params:
+                raise Exception(f'Missing parameter "{key}" in config file: {configFile}')
+
+        groupKey = (params['sdloControllerIp'], params['user'], params['password'])
+        groups.setdefault(groupKey, []).append((configFile, params))
+
+    return groups
+
+def runSandbox(controller, configFile, params, args):
+    """
+    Reserve and/or release one sandbox using a sandbox handle of the controller.
+
+    Return
+       The summary of the sandbox
+    """
+    summary = {'configFile': configFile,
+               'controller': params['sdloControllerIp'],
+               'sandbox': params['sandbox'],
+               'status': 'passed',
+               'blueprintChild': None,
+               'duration': None,
+               'error': None}
+
+    startTime = time.perf_counter()
+    try:
+        if args.broker:
+            runSandboxInBroker(params, args, summary)
+        else:
+            # reserve() reads the device details after reserving. release() finds the sandbox
+            # to release in the reservation state file. No need to read the sandbox up front.
+            sandboxObj = controller.sandbox(params['sandbox'], getDeviceDetails=False)
+
+            if args.reserve:
+                sandboxObj.reserve(forceTakeOwnership=args.forceTakeOwnership)
+                summary['blueprintChild'] = sandboxObj.blueprintChild
+
+            if args.release:
+                sandboxObj.release()
+
+    except Exception as errMsg:
+        summary['status'] = 'failed'
+        summary['error'] = str(errMsg)
+
+    summary['duration'] = round(time.perf_counter() - startTime, 3)
+    return summary
+
+def runSandboxInBroker(params, args, summary):
+    """
+    Reserve and/or release one sandbox using a running sdloBroker
+    """
+    import sdloBroker
+
+    login = (params['sdloControllerIp'], params['user'], params['password'], params['sandbox'])
+
+    with sdloBroker.BrokerClient(args.broker) as broker:
+        if args.reserve:
+            result = broker.send('reserve', *login, forceTakeOwnership=args.forceTakeOwnership)
+            summary['blueprintChild'] = result['blueprintChild']
+
+        if args.release:
+            broker.send('release', *login)
+
+def sweep(groups, args):
+    """
+    Release the stale reservations on each controller. See Controller.sweepReservations().
+
+    Return
+       A list of the sweep results of all the controllers
+    """
+    results = []
+    for (controllerIp, user, password), configs in groups.items():
+        controller = sdloAssistant.Controller(controllerIp, user, password, poolSize=args.parallel)
+
+        try:
+            controllerResults = controller.sweepReservations(owner=args.owner, namePattern=args.namePattern,
+                                                             sandboxType=args.sandboxType,
+                                                             olderThan=args.olderThan * 60 if args.olderThan else None,
+                                                             parallel=args.parallel, dryRun=args.dryRun)
+        except Exception as errMsg:
+            controllerResults = [{'sandbox': None, 'status': 'failed', 'error': str(errMsg)}]
+
+        for result in controllerResults:
+            result['controller'] = controllerIp
+            results.append(result)
+
+    return results
+
+def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-sandbox', help='The sandbox yml config file')
+    parser.add_argument('-sandbox', required=True, nargs='+',
+                        help='The sandbox yml config files, directories of yml files or glob patterns')
     parser.add_argument('-reserve', action='store_true', help='Reserve the sandbox')
     parser.add_argument('-release', action='store_true', help='Release the sandbox.')
     parser.add_argument('-forceTakeOwnership', action='store_true', default=False,
                         help='For sandbox reservation only. Force take ownership of sandbox if it is reserved.')
+    parser.add_argument('-parallel', type=int, default=1,
+                        help='How many sandboxes to reserve or release at the same time. Defaults to 1.')
+    parser.add_argument('-summary', default=None, help='Write the JSON summary to this file')
+    parser.add_argument('-broker', default=None, help='Use the sdloBroker listening on this Unix socket file')
+    parser.add_argument('-sweep', action='store_true', help='Release the stale reservations on the controllers')
+    parser.add_argument('-owner', default=None,
+                        help='For -sweep. The user that reserved the sandboxes. Defaults to the yml user. any = any user.')
+    parser.add_argument('-namePattern', default=None, help='For -sweep. A regex of the sandbox names to release.')
+    parser.add_argument('-sandboxType', default=None, choices=['regular', 'child'],
+                        help='For -sweep. Only release this sandbox type.')
+    parser.add_argument('-olderThan', type=int, default=None,
+                        help='For -sweep. Only release sandboxes reserved more than this many minutes ago.')
+    parser.add_argument('-dryRun', action='store_true', help='For -sweep. Only list the sandboxes to release.')
+    parser.add_argument('-profile', '--profile', default=None,
+                        help='Write cProfile stats of the main thread to this file and collapsed stacks of all threads '
+                             'to <file>.collapsed. Use -parallel 1 to get the REST calls in the cProfile stats.')
     args = parser.parse_args()
-    
-    if not os.path.exists(args.sandbox):
-        raise Exception(f'No such config file found: {args.sandbox}')
 
-    with open(args.sandbox) as paramsObj:
-        params = yaml.safe_load(paramsObj)
-        
-    print(f'\nconfigFile params: {params}')
+    if args.sweep and (args.reserve or args.release):
+        parser.error('-sweep cannot be used with -reserve or -release')
+
+    if not args.reserve and not args.release and not args.sweep:
+        parser.error('Include -reserve, -release or -sweep')
+
+    if args.parallel < 1:
+        parser.error('-parallel must be 1 or more')
+
+    import json
 
-    sandboxObj = sdloAssistant.Controller(params['sdloControllerIp'], params['user'], params['password'])
+    profiler = None
+    if args.profile:
+        import sdloProfiler
+        profiler = sdloProfiler.Profiler(args.profile)
+        profiler.start()
 
-    # Set the sandbox name to use
-    sandboxObj.setSandbox(params['sandbox'])
+    try:
+        summary = run(args)
+    finally:
+        if profiler:
+            profiler.stop()
 
-    if args.reserve:
-        sandboxObj.reserve(forceTakeOwnership=args.forceTakeOwnership)
+    summaryJson = json.dumps(summary, indent=2)
+    if args.summary:
+        with open(args.summary, 'w') as summaryFile:
+            summaryFile.write(summaryJson + '\n')
 
-    if args.release:
-        sandboxObj.release()
+    print(f'\nreserveSandbox.py summary:\n{summaryJson}\n')
+
+    if summary['failed']:
+        sys.exit(1)
 
     sys.exit(0)
-    
-except Exception as errMsg:
-    print(f'\nreserveSandbox.py error: {errMsg}\n{traceback.format_exc()}\n')
-    sys.exit(1)
-    
+
+def run(args):
+    """
+    Run the action of the command line args
+
+    Return
+       The summary dict
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    startTime = time.perf_counter()
+
+    if args.sweep:
+        groups = groupByController(getConfigFiles(args.sandbox), requiredKeys=('sdloControllerIp', 'user', 'password'))
+        sandboxes = sweep(groups, args)
+        action = 'sweep'
+        passed = ['released', 'dryRun']
+    else:
+        groups = groupByController(getConfigFiles(args.sandbox))
+        sandboxes = []
+        futures = []
+        # With -parallel 1 the sandboxes run in the main thread, where cProfile records them
+        executor = ThreadPoolExecutor(max_workers=args.parallel) if args.parallel > 1 else None
+        try:
+            for (controllerIp, user, password), configs in groups.items():
+                # One login per controller and user. The sandboxes use handles of this controller.
+                # With -broker, the broker keeps the logins.
+                controller = None
+                if not args.broker:
+                    controller = sdloAssistant.Controller(controllerIp, user, password, poolSize=args.parallel)
+
+                for configFile, params in configs:
+                    if executor:
+                        futures.append(executor.submit(runSandbox, controller, configFile, params, args))
+                    else:
+                        sandboxes.append(runSandbox(controller, configFile, params, args))
+        finally:
+            if executor:
+                executor.shutdown()
+
+        sandboxes += [future.result() for future in futures]
+        action = '+'.join(eachAction for eachAction in ['reserve', 'release'] if getattr(args, eachAction))
+        passed = ['passed']
+
+    summary = {'action': action,
+               'passed': len([eachSandbox for eachSandbox in sandboxes if eachSandbox['status'] in passed]),
+               'failed': len([eachSandbox for eachSandbox in sandboxes if eachSandbox['status'] == 'failed']),
+               'duration': round(time.perf_counter() - startTime, 3),
+               'sandboxes': sandboxes}
+
+    return summary
+
+
+if __name__ == '__main__':
+    try:
+        main()
+
+    except Exception as errMsg:
+        import traceback
+        print(f'\nreserveSandbox.py error: {errMsg}\n{traceback.format_exc()}\n')
+        sys.exit(1)
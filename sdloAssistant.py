@@ -3,7 +3,7 @@ sdloAssistant.py
 
 A class that sends Tokalabs REST APIs using Python requests
 
-There are two ways to use this class:
+There are three ways to use this class:
 
 1> This option was the original method by creating an instance for a sandbox.
     This means you have to create a new instance for each sandbox that you like to control.
@@ -17,6 +17,16 @@ There are two ways to use this class:
     sandbox = sdloAssistant.Controller(sdloControllerIp, username, password)
     sandbox.setSandbox(sandboxName)
     sandbox.reserve()
+
+3> This option creates one instance and a handle for each sandbox.
+    Each handle owns its sandbox state and shares the login token and the connection pool
+    of the Controller. Handles are safe to use concurrently from multiple threads.
+
+    controller = sdloAssistant.Controller(sdloControllerIp, username, password)
+    sandbox_1 = controller.sandbox('testbed_1')
+    sandbox_2 = controller.sandbox('testbed_2')
+    sandbox_1.reserve()
+    sandbox_2.reserve()
     
 To run a suite in a sandbox instance, pass in the suite name to the runSuite() function.
     
@@ -30,16 +40,126 @@ By Hubert Gee
 
 from __future__ import absolute_import, print_function, division
 
-import os, re, requests, urllib3, time, datetime, platform, inspect, yaml, json
-import timeit
-from pprint import pprint
+# Keep the module imports cheap. requests, urllib3 and the JSON parser are imported
+# on the first REST call so scripts that fail argument validation or never talk to the
+# controller don't pay for them.
+import os, sys, re, time, datetime, threading
+
+def jsonLoads(data):
+    """
+    Parse a JSON document. Uses orjson or ujson if installed.
+    The parser is picked on the first call and then replaces this function.
+    """
+    global jsonLoads
+
+    try:
+        import orjson
+        jsonLoads = orjson.loads
+    except ImportError:
+        try:
+            import ujson
+            jsonLoads = ujson.loads
+        except ImportError:
+            import json
+            jsonLoads = json.loads
+
+    return jsonLoads(data)
+
+# The reservations made by reserve(). See ReservationState.
+defaultStateFile = os.path.join(os.path.expanduser('~'), '.sdloAssistant', 'reservations.json')
+
+# The reservationDetails fields that hold who reserved a sandbox and when.
+# The first field found is used.
+reservationOwnerFields = ['reservedBy', 'user', 'owner']
+reservationTimeFields = ['reservedOn', 'reservationTime', 'startTime']
+
+def getReservationField(reservationDetails, fields):
+    for field in fields:
+        if reservationDetails.get(field) not in [None, '']:
+            return reservationDetails[field]
+
+def parseTimestamp(timestamp):
+    """
+    Convert a reservation timestamp to epoch seconds.
+    Accepts epoch seconds, epoch milliseconds and ISO 8601 strings.
+
+    Return
+       Epoch seconds | None
+    """
+    if timestamp is None:
+        return None
+
+    try:
+        timestamp = float(timestamp)
+    except (TypeError, ValueError):
+        try:
+            return datetime.datetime.fromisoformat(str(timestamp).replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return None
+
+    # Epoch milliseconds
+    if timestamp > 1e11:
+        timestamp = timestamp / 1000
+
+    return timestamp
+
+# Replace the sandbox names, user names, tokens and query values in a REST url with {}
+# so the REST calls can be grouped by endpoint. See endpointTemplate().
+endpointPatterns = [('^/tokalabs/api/topology/[^/?]+', '/tokalabs/api/topology/{}'),
+                    ('^/tokalabs/api/keywords/sandbox/[^/?]+', '/tokalabs/api/keywords/sandbox/{}'),
+                    ('^/testrunner/[^/?]+', '/testrunner/{}'),
+                    ('=[^/&]*', '={}')]
+
+# Functions that only build a query for other functions. The REST calls they make are
+# logged and reported to the hooks under the name of the function that called them.
+restHelpers = {'getTopologies', 'getSandboxDetails', 'getDeviceDetails', 'getDevicesByName',
+               'fetchSandboxKeywords'}
+
+def getCallerName(frame):
+    """
+    Return the name of the function that made a REST call, skipping the restHelpers.
+    Stops at the first frame outside of this module, like a thread pool worker.
+    """
+    while frame.f_code.co_name in restHelpers and frame.f_back is not None and \
+          frame.f_back.f_code.co_filename == __file__:
+        frame = frame.f_back
+
+    return frame.f_code.co_name
+
+def endpointTemplate(restApi):
+    """
+    Ex: /tokalabs/api/topology/testbed_1/reserve/user=admin/token=abc
+        -> /tokalabs/api/topology/{}/reserve/user={}/token={}
+    """
+    for pattern, replacement in endpointPatterns:
+        restApi = re.sub(pattern, replacement, restApi)
+
+    return restApi
+
+def exactNamePattern(name):
+    """
+    A name filter regex that only matches this name. Ex: lab+1 -> ^lab\\+1$
+    """
+    return '^{}$'.format(re.escape(name))
+
+def joinFields(fieldsToFetch):
+    """
+    Format a list of fields for the fieldsToFetch query parameter
+    """
+    if isinstance(fieldsToFetch, str):
+        return fieldsToFetch
+
+    return ','.join(fieldsToFetch)
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 class Controller:
     logFile = None
+    isLogFileStarted = False
+    # Serializes log file writes from sandbox handles running in multiple threads
+    logLock = threading.Lock()
 
-    def __init__(self, controllerIp, user, password, sandbox=None, logLevel='debug'):
+    def __init__(self, controllerIp, user, password, sandbox=None, logLevel='debug', poolSize=10,
+                 stateFile=defaultStateFile, protocol='https'):
         """
         Parameters
            controllerIp <str>: The Tokalabs controller IP address.
@@ -50,6 +170,13 @@ class Controller:
                                passing in the sandbox name to use.
 
            logLevel <str>: info|debug.  The debug option includes rest api commands.
+           poolSize <int>: The max number of pooled connections to the controller.
+                           Raise this if many sandbox handles are used concurrently.
+           stateFile <None|str>: The file that keeps the reservations made by reserve() so
+                                 release() from another process knows the blueprint child
+                                 sandbox name. None = don't keep reservations in a file.
+           protocol <str>: https|http. http is only for local stand-ins of the controller.
+                           See simulateReservations.py.
 
         Usage example:
            sandboxObj = sdloAssistant.Controller(sdloControllerIp, username, password)
@@ -60,56 +187,155 @@ class Controller:
         self.controllerIp = controllerIp
         self.user = user
         self.password = password
-        self.sandbox = sandbox
+        self.sandboxName = sandbox
         # blueprintChild will be updated with a blueprint sandbox child name if it's a blueprint reservation
         self.blueprintChild = None
+        # This gets filled in getDeviceMgmtInterfaceDetails()
+        self.deviceDict = {}
+        self.reservationState = ReservationState(stateFile) if stateFile else None
         self.logLevel = logLevel
-        self.httpHeader = 'https://{}'.format(self.controllerIp)
+        self.httpHeader = '{}://{}'.format(protocol, self.controllerIp)
         self.headers = {'Content-Type': 'application/json'}
 
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-        # Initiate a log file
-        currentDir = os.path.dirname(os.path.abspath(__file__))
-        Controller.logFile = '{}/{}'.format(currentDir, 'sdloAssistant.log')
-
-        today = str(datetime.datetime.now()).split(' ')[0]
-        with open(Controller.logFile, 'w+') as sdloLogFile:
-            sdloLogFile.write('Log date: {}\n\n'.format(today))
-
-        self.connect()
-
-        if self.sandbox:
-            self.setSandbox(self.sandbox)
+        # The login is made by the first REST call. See connectIfNeeded().
+        self.token = None
+        self.webtoken = None
+
+        # One connection pool shared by this instance and all of its sandbox handles.
+        # Created by the first REST call. See openSession().
+        self.session = None
+        self.poolSize = poolSize
+
+        # Sandbox handles created by sandbox(). Keyed by the sandbox name.
+        self.sandboxHandles = {}
+
+        # Functions called on every REST call. See addHook().
+        self.hooks = {'beforeRequest': [], 'afterResponse': [], 'onError': []}
+
+        # Sandbox keywords read by loadSandboxKeywords(). Shared with the sandbox handles.
+        # {(sandbox, executionProfile): {keywordName: keyword}}
+        self.keywordCache = {}
+        # {sandbox: generation}: Incremented by postSandboxKeywords(). Keywords read while
+        # the generation changed may be from before the post and aren't cached.
+        self.keywordGenerations = {}
+        self.lock = threading.RLock()
+
+        # Initiate a log file. It gets started with the first log message.
+        # Controllers created later in the same process append to the same log file.
+        if Controller.logFile is None:
+            currentDir = os.path.dirname(os.path.abspath(__file__))
+            Controller.logFile = '{}/{}'.format(currentDir, 'sdloAssistant.log')
+
+        if self.sandboxName:
+            self.setSandbox(self.sandboxName)
             
     def connect(self):
         """
         Make initial connection to Tokalabs with username/password.
         This will automatically get the webtoken and token for the requests headers
         """
-        response = self.sendRest('post', '/tokalabs/api/login',
-                                 {'username': self.user, 'password': self.password})
+        with self.lock:
+            response = self.sendRest('post', '/tokalabs/api/login',
+                                     {'username': self.user, 'password': self.password})
+
+            # Ex: admin/NPT0PXsm6KNl4RQe
+            token = response.json()['additionalDetails']['token']['token']
+
+            # connectIfNeeded() only checks self.token without the lock.
+            # Set the webtoken and the headers first so they are ready when the token is seen.
+            # Ex: NPT0PXsm6KNl4RQe
+            self.webtoken = token.split('/')[1]
+            self.headers = {'Content-Type': 'application/json', 'Authorization': token}
+            self.token = token
+
+    def connectIfNeeded(self):
+        """
+        Login if this instance hasn't logged in yet.
+        Functions that put the webtoken in the url call this before building the url.
+        """
+        if self.token is None:
+            with self.lock:
+                if self.token is None:
+                    self.connect()
+
+    def getSession(self):
+        """
+        Get the pooled requests session. It is created on first use.
+        """
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    self.session = self.openSession()
 
-        # Ex: NPT0PXsm6KNl4RQe
-        self.webtoken = response.json()['additionalDetails']['token']['token'].split('/')[1]
+        return self.session
 
-        # Ex: admin/NPT0PXsm6KNl4RQe
-        self.token = response.json()['additionalDetails']['token']['token']
+    def openSession(self):
+        """
+        Create the pooled requests session
+        """
+        import requests, urllib3
+        from requests.adapters import HTTPAdapter
+
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-        self.headers = {'Content-Type': 'application/json', 'Authorization': self.token}
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.poolSize, pool_maxsize=self.poolSize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
-    def setSandbox(self, sandbox):
+    def setSandbox(self, sandbox, getDeviceDetails=True):
         """
         Verify if the sandbox is already reserved. If it is, get the device details.
 
-        Parameter
+        Note:
+           This switches the sandbox of this instance and is kept for backward compatibility.
+           To control multiple sandboxes, especially from multiple threads, use sandbox()
+           to get a handle for each sandbox.
+
+        Parameters
            sandbox <str>: The sandbox to use
+           getDeviceDetails <bool>: False = don't query the sandbox now. Use this if the
+                                    sandbox is only going to be reserved or released.
         """
-        self.sandbox = sandbox
+        self.sandboxName = sandbox
+        self.blueprintChild = None
         # This gets filled in getDeviceMgmtInterfaceDetails()
         self.deviceDict = {} 
-        if self.isSandboxReserved() == True:
+        if getDeviceDetails and self.isSandboxReserved() == True:
             self.getDeviceMgmtInterfaceDetails()
+
+    def sandbox(self, sandbox, getDeviceDetails=True):
+        """
+        Get a handle for a sandbox.
+
+        The handle has all the Controller functions and owns its sandbox state
+        (sandboxName, deviceDict, blueprintChild). It shares the login token and the
+        connection pool of this Controller so no additional login is made.
+        Asking for the same sandbox name again returns the same handle.
+
+        Parameters
+           sandbox <str>: The sandbox name
+           getDeviceDetails <bool>: False = don't query the sandbox when the handle is created.
+                                    See setSandbox().
+
+        Usage example:
+           controller = sdloAssistant.Controller(sdloControllerIp, username, password)
+           sandbox_1 = controller.sandbox('testbed_1')
+           sandbox_1.reserve()
+           ip = sandbox_1.getDeviceIp('IxNetworkAPIServer')
+
+        Return
+           A SandboxHandle object
+        """
+        with self.lock:
+            if sandbox in self.sandboxHandles:
+                return self.sandboxHandles[sandbox]
+
+        # Creating a handle queries the controller. Don't hold the lock while doing it.
+        handle = SandboxHandle(self, sandbox, getDeviceDetails=getDeviceDetails)
+        with self.lock:
+            return self.sandboxHandles.setdefault(sandbox, handle)
         
     def sendRest(self, verb, restApi, params={}):
         """
@@ -124,32 +350,150 @@ class Controller:
                                      New API for reserving/releasing blueprints uses application/xml
 
         Return
-            The response from the controller
+            The response from the controller wrapped in a RestResponse.
+            The JSON body is parsed once no matter how many times response.json() is called.
         """
+        session = self.getSession()
+
+        if restApi != '/tokalabs/api/login':
+            self.connectIfNeeded()
+
+        callerName = getCallerName(sys._getframe(1))
         self.logInternal('{}()\n\t{}: {} \n\tJSON DATA: {}'.format(
-            inspect.stack()[1][3],
+            callerName,
             verb.upper(),
             self.httpHeader+restApi,
             params))
 
-        if verb == 'get':
-            response = requests.get(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
+        hooks = self.hooks
+        requestInfo = None
+        if hooks['beforeRequest'] or hooks['afterResponse'] or hooks['onError']:
+            import json
+
+            requestInfo = {'method': callerName,
+                           'verb': verb,
+                           'endpoint': endpointTemplate(restApi),
+                           'url': self.httpHeader+restApi,
+                           'sandbox': self.sandboxName,
+                           'payloadSize': len(json.dumps(params)) if params else 0}
+            self.runHooks('beforeRequest', requestInfo)
+
+        response = None
+        startTime = time.perf_counter()
+        try:
+            if verb == 'get':
+                response = session.get(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
+
+            if verb == 'post':
+                response = session.post(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
 
-        if verb == 'post':
-            response = requests.post(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
+            if verb == 'put':
+                response = session.put(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
 
-        if verb == 'put':
-            response = requests.put(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
+            if verb == 'delete':
+                response = session.delete(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
 
-        if verb == 'delete':
-            response = requests.delete(self.httpHeader+restApi, json=params, headers=self.headers, verify=False)
+            response = RestResponse(response)
 
-        if str(response.status_code).startswith('2') == False:
-            raise SdloAssistantException('response status_code = {}\n{}'.format(response.status_code,
-                                                                                response.json()))
+            if str(response.status_code).startswith('2') == False:
+                try:
+                    errorDetails = response.json()
+                except ValueError:
+                    errorDetails = response.text
+
+                raise SdloAssistantException('response status_code = {}\n{}'.format(response.status_code,
+                                                                                    errorDetails))
+        except Exception as errMsg:
+            if requestInfo:
+                requestInfo.update({'elapsed': time.perf_counter() - startTime, 'error': errMsg,
+                                    'statusCode': getattr(response, 'status_code', None)})
+                self.runHooks('onError', requestInfo)
+            raise
+
+        if requestInfo:
+            requestInfo.update({'elapsed': time.perf_counter() - startTime, 'statusCode': response.status_code,
+                                'responseSize': len(response.content)})
+            self.runHooks('afterResponse', requestInfo)
 
         return response
 
+    def addHook(self, event, hook):
+        """
+        Call a function on every REST call of this Controller and its sandbox handles.
+
+        Parameters
+           event <str>: beforeRequest: Before the request is sent.
+                        afterResponse: After a successful response.
+                        onError: After a failed request or a response that isn't a 2xx status code.
+           hook <function>: Called with one dict:
+                            {'method': <The sdloAssistant function that made the call. See restHelpers.>,
+                             'verb': 'get', 'endpoint': '/tokalabs/api/topology/{}/reserve/user={}/token={}',
+                             'url': <The full url>, 'sandbox': <sandbox name>, 'payloadSize': <bytes>}
+                            afterResponse adds elapsed (seconds), statusCode and responseSize.
+                            onError adds elapsed, statusCode and error.
+                            An exception raised by a hook is logged and ignored.
+
+        Usage example:
+           def audit(requestInfo):
+               print(requestInfo['method'], requestInfo['endpoint'], requestInfo['elapsed'])
+
+           controller.addHook('afterResponse', audit)
+        """
+        if event not in self.hooks:
+            raise SdloAssistantException('Unknown hook event: {}. Use {}'.format(event, list(self.hooks)))
+
+        with self.lock:
+            # Replace the list instead of appending so threads iterating the hooks aren't affected
+            self.hooks[event] = self.hooks[event] + [hook]
+
+    def removeHook(self, event, hook):
+        with self.lock:
+            self.hooks[event] = [eachHook for eachHook in self.hooks[event] if eachHook != hook]
+
+    def runHooks(self, event, requestInfo):
+        for hook in self.hooks[event]:
+            try:
+                hook(requestInfo)
+            except Exception as errMsg:
+                self.logError('{} hook {} failed: {}'.format(event, getattr(hook, '__name__', hook), errMsg))
+
+    def getTopologies(self, name=None, fieldsToFetch=None):
+        """
+        Query the topologies (sandboxes and blueprints).
+
+        Parameters
+           name <None|str>: A sandbox name filter. The controller treats it as a regex.
+                            Ex: ^testbed_1$
+           fieldsToFetch <None|str|list>: Only return these fields of each topology.
+                                          Ex: ['name', 'reservationDetails']
+                                          None = return the full topology documents.
+
+        Return
+           The topologiesList
+        """
+        response = self.sendRest('get', self.topologiesUrl(name, fieldsToFetch))
+        return response.json()['additionalDetails']['topologiesList']
+
+    def topologiesUrl(self, name=None, fieldsToFetch=None):
+        """
+        Build the topologies query url with an optional name filter and field projection.
+        The name regex is url quoted so characters like + & # reach the controller as is.
+        """
+        from urllib.parse import quote
+
+        query = []
+        if name is not None:
+            query.append('name={}'.format(quote(name, safe='')))
+
+        if fieldsToFetch:
+            query.append('fieldsToFetch={}'.format(joinFields(fieldsToFetch)))
+
+        url = '/tokalabs/api/topologies'
+        if query:
+            url += '?' + '&'.join(query)
+
+        return url
+
     def logMsg(self, msgType, msg):
         """
         This is a private function for sdloAssistant use only.
@@ -164,16 +508,32 @@ class Controller:
         if self.logLevel == 'debug' and msgType == 'internal':
             debugFormat = '\n{}: [sdloAssistant]: {}'.format(timestamp, msg)
             print(debugFormat)
-
-            with open(Controller.logFile, 'a') as sdlLogFile:
-                sdlLogFile.write(debugFormat+'\n')
+            Controller.writeLogFile(debugFormat+'\n')
 
         if msgType in ['info', 'error', 'debug']:
             infoFormat = '\n{}: [{}]: {}'.format(timestamp, msgType, msg)
             print(infoFormat)
+            Controller.writeLogFile(infoFormat+'\n')
+
+    @classmethod
+    def writeLogFile(cls, msg):
+        """
+        Append a message to the log file.
+        The log file is started fresh with the first message after creating a Controller.
+        """
+        if cls.logFile is None:
+            return
+
+        with cls.logLock:
+            if cls.isLogFileStarted == False:
+                today = str(datetime.datetime.now()).split(' ')[0]
+                with open(cls.logFile, 'w+') as sdloLogFile:
+                    sdloLogFile.write('Log date: {}\n\n'.format(today))
 
-            with open(Controller.logFile, 'a') as sdlLogFile:
-                sdlLogFile.write(infoFormat+'\n')
+                cls.isLogFileStarted = True
+
+            with open(cls.logFile, 'a') as sdlLogFile:
+                sdlLogFile.write(msg)
 
     def logInfo(self, msg):
         self.logMsg('info', msg)
@@ -195,25 +555,26 @@ class Controller:
            True: Sandbox is currently reserved
            False: Sandbox is available
         """
-        url = '/tokalabs/api/topologies?name=^{}$'.format(self.sandbox)
-        response = self.sendRest('get', url)
+        topologyList = self.getTopologies(name=exactNamePattern(self.sandboxName),
+                                          fieldsToFetch=['name', 'reservationDetails'])
 
-        for sandbox in response.json()['additionalDetails']['topologiesList']:
-            if sandbox['name'] == self.sandbox:
+        for sandbox in topologyList:
+            if sandbox['name'] == self.sandboxName:
                 self.logInternal('reservation details: {}'.format(sandbox['reservationDetails']))
                 reservationStatus = sandbox['reservationDetails']['reservationStatus']
 
-                self.logInternal('SandboxName [{}] status: {}'.format(self.sandbox, reservationStatus))
+                self.logInternal('SandboxName [{}] status: {}'.format(self.sandboxName, reservationStatus))
 
                 if reservationStatus == 'reserved':
-                    self.logInternal('Sandbox is currently reserved: {}'.format(self.sandbox))
+                    self.logInternal('Sandbox is currently reserved: {}'.format(self.sandboxName))
                     return True
 
                 if reservationStatus == 'available':
-                   self.logInternal('Sandbox is available: {}'.format(self.sandbox))
+                   self.logInternal('Sandbox is available: {}'.format(self.sandboxName))
                    return False
 
-    def reserve(self, forceTakeOwnership=False):
+    def reserve(self, forceTakeOwnership=False, waitInterval=3, backoff=1, maxWaitInterval=60, jitter=0,
+                wait=True):
         """
         Reserve a sandbox or a blueprint.
         If forceTakeOwnership is False, wait until the sandbox is available.
@@ -222,16 +583,29 @@ class Controller:
         Note:
             If reserving a blueprint, a child sandbox is created. The name of the child sandbox is
             saved in self.blueprintChild so the release() function knows which sandbox to release.
-            You need to be running a contiguous script for this to work.
-            Otherwise, you need to keep track of the child sandbox name.
+            The reservation is also saved in the state file so release() from another process
+            knows the child sandbox name. See listMyReservations().
 
-        Parameter
+        Parameters
            forceTakeOwnership <bool>: True = take over the sandbox that is currently owned.
+           waitInterval <int|float>: Seconds to wait before checking a reserved sandbox again.
+           backoff <int|float>: Multiply the wait by this after each check. 1 = check at a fixed interval.
+           maxWaitInterval <int|float>: The longest wait between checks when backoff is more than 1.
+           jitter <float>: 0-1. Randomize each wait by up to this fraction so jobs waiting for
+                           the same sandbox don't all check it at the same time.
+           wait <bool>: False = raise SdloAssistantException if the sandbox is reserved
+                        instead of waiting for it.
+
+        Usage example:
+           # Check every 3 seconds
+           obj.reserve()
+
+           # Check after 5, 10, 20, 40, 60, 60, ... seconds, each +/- 20%
+           obj.reserve(waitInterval=5, backoff=2, maxWaitInterval=60, jitter=0.2)
         """
-        if self.isSandboxExists(self.sandbox) == False:
-            raise SdloAssistantException('The Sandbox [{}] does not exists'.format(self.sandbox))
+        if self.isSandboxExists(self.sandboxName) == False:
+            raise SdloAssistantException('The Sandbox [{}] does not exists'.format(self.sandboxName))
 
-        waitInterval = 3
         while True:
             result = self.isSandboxReserved()
 
@@ -240,37 +614,57 @@ class Controller:
                 self.release()
                 break
 
+            if result == True and forceTakeOwnership in [False, 'False'] and not wait:
+                raise SdloAssistantException('Sandbox [{}] is currently reserved'.format(self.sandboxName))
+
             if result == True and forceTakeOwnership in [False, 'False']:
-                self.logInternal('Sandbox [{}] is currently reserved. Waiting for owner to release it.'.format(self.sandbox))
-                time.sleep(waitInterval)
+                self.logInternal('Sandbox [{}] is currently reserved. Waiting for owner to release it.'.format(self.sandboxName))
+                sleepTime = waitInterval
+                if jitter:
+                    import random
+                    sleepTime *= random.uniform(1 - jitter, 1 + jitter)
+
+                time.sleep(sleepTime)
+                if backoff > 1:
+                    waitInterval = min(waitInterval * backoff, maxWaitInterval)
+
                 continue
 
             if result == False:
                 break
 
-        url = '/tokalabs/api/topology/{}/reserve/user={}/token={}'.format(self.sandbox, self.user,
+        self.connectIfNeeded()
+        url = '/tokalabs/api/topology/{}/reserve/user={}/token={}'.format(self.sandboxName, self.user,
                                                                           self.webtoken.strip())
 
-        self.logInfo('Reserving sandbox: {}'.format(self.sandbox))
+        self.logInfo('Reserving sandbox: {}'.format(self.sandboxName))
 
         # Time how long it took to reserve all the devices in the sandbox.
-        startTime = timeit.default_timer()
+        startTime = time.perf_counter()
 
-        response = self.sendRest('get', url)
-        if response.json()['status'] != 'Sandbox Reserved Successfully':
-            raise SdloAssistantException('Reserving sandbox failed: {}'.format(response.json()['status']))
+        result = self.sendRest('get', url).json()
+        if result['status'] != 'Sandbox Reserved Successfully':
+            raise SdloAssistantException('Reserving sandbox failed: {}'.format(result['status']))
 
-        self.logInfo('Successfully reserved sandbox: {}'.format(response.json()['TopologyName']))
-        stopTime = timeit.default_timer()
+        self.logInfo('Successfully reserved sandbox: {}'.format(result['TopologyName']))
+        stopTime = time.perf_counter()
         totalTime = stopTime - startTime
         self.logInfo('Time taken to make the reservation: {} seconds -> {} minutes'.format(totalTime, int(totalTime/60)))
 
-        reservedSandboxName = response.json()['TopologyName']
-        if reservedSandboxName != self.sandbox:
+        reservedSandboxName = result['TopologyName']
+        if reservedSandboxName != self.sandboxName:
             self.blueprintChild = reservedSandboxName
             self.logInfo('The blueprint child sandbox name is: {}'.format(self.blueprintChild))
         else:
-            self.logInfo('The reserved sandbox name is: {}'.format(self.sandbox))
+            self.logInfo('The reserved sandbox name is: {}'.format(self.sandboxName))
+
+        if self.reservationState:
+            self.reservationState.add({'controllerIp': self.controllerIp,
+                                       'user': self.user,
+                                       'sandbox': self.sandboxName,
+                                       'reservedSandbox': reservedSandboxName,
+                                       'blueprintChild': self.blueprintChild,
+                                       'reserveTime': time.time()})
 
         # Get all the sandbox devices and details and store in a dict so functions like
         # getDeviceIp, getDevicePorts, getDeviceUsername,... won't need to keep calling a for loop.
@@ -282,36 +676,186 @@ class Controller:
 
         Note:
            If you are not running a contiguous script that includes both reserve() and
-           release() in the same script, you will need to pass in the sandbox name to be released.
-           Especially if the sandbox is a child of a blueprint. The blueprint child
-           sandbox name is obfuscated.
-        """
+           release() in the same script, the sandbox to release is looked up in the state file
+           written by reserve(). If the sandbox isn't in the state file, you will need to pass in
+           the sandbox name to be released. Especially if the sandbox is a child of a blueprint.
+           The blueprint child sandbox name is obfuscated.
+           If the state file has more than one reserved child of the blueprint, the children
+           are listed in the exception and the child sandbox name needs to be passed in.
+           A blueprint without a known child raises SdloAssistantException since nothing can be released.
+        """
+        reservation = None
+        if self.reservationState and not self.blueprintChild:
+            # The reservations of this sandbox made by reserve() in any process
+            reservations = self.reservationState.find(self.controllerIp, self.user, self.sandboxName)
+
+            if len(reservations) > 1:
+                raise SdloAssistantException('"{}" has more than one reserved blueprint child sandbox: {}. Pass in the child sandbox name to release.'.format(
+                    self.sandboxName, [eachReservation['reservedSandbox'] for eachReservation in reservations]))
+
+            if reservations:
+                reservation = reservations[0]
+
         if self.blueprintChild:
             # The self.blueprintChild is defined in reserve()
             sandbox = self.blueprintChild
+        elif reservation:
+            sandbox = reservation['reservedSandbox']
+            self.logInternal('Found the reservation of {} in the state file: {}'.format(self.sandboxName, reservation))
         else:
             # Sandbox types: child, blueprint, regular
             sandboxType = self.getSandboxType()
 
             if sandboxType == 'blueprint':
-                self.logError('"{}" is a blueprint type.  You need to provide the blueprint child sandbox name or a regular sandbox name'.format(
-                    self.sandbox))
-                return
+                # Nothing was released. Raise so callers like reserveSandbox.py don't report success.
+                raise SdloAssistantException('"{}" is a blueprint type.  You need to provide the blueprint child sandbox name or a regular sandbox name'.format(
+                    self.sandboxName))
             else:
-                sandbox = self.sandbox
+                sandbox = self.sandboxName
+
+        self.releaseSandbox(sandbox)
+        self.blueprintChild = None
+
+    def releaseSandbox(self, sandbox):
+        """
+        Send the release of a sandbox or a blueprint child sandbox by its name.
+        Unlike release(), this doesn't look up which sandbox to release.
 
+        Parameter
+           sandbox <str>: The sandbox or blueprint child sandbox name
+        """
         self.logInfo('Releasing sandbox: {}'.format(sandbox))
+        self.connectIfNeeded()
         url = '/tokalabs/api/topology/{}/release/user={}/token={}'.format(sandbox, self.user, self.webtoken.strip())
-        startTime = timeit.default_timer()
-        response = self.sendRest('get', url)
+        startTime = time.perf_counter()
+        result = self.sendRest('get', url).json()
 
-        stopTime = timeit.default_timer()
+        stopTime = time.perf_counter()
         totalTime = stopTime - startTime
         self.logInfo('Time taken to release the sandbox: {} seconds -> {} minutes'.format(totalTime, int(totalTime/60)))
 
-        self.logInfo('Release sandboxName [{}] status: {}'.format(sandbox, response.json()['status']))
-        if response.json()['status'] != 'Sandbox Released Successfully':
-            raise SdloAssistantException('Release sandbox failed: {}. {}'.format(response.json()['status'], response.json()['message']))
+        self.logInfo('Release sandboxName [{}] status: {}'.format(sandbox, result['status']))
+        if result['status'] != 'Sandbox Released Successfully':
+            raise SdloAssistantException('Release sandbox failed: {}. {}'.format(result['status'], result['message']))
+
+        if self.reservationState:
+            self.reservationState.remove(self.controllerIp, sandbox)
+
+    def sweepReservations(self, owner=None, namePattern=None, sandboxType=None, olderThan=None,
+                          parallel=4, dryRun=False):
+        """
+        Release stale reservations, such as the sandboxes and blueprint children left
+        reserved by crashed CI runs.
+
+        All the topologies are read with one query and filtered here. The matches are
+        released concurrently.
+
+        Parameters
+           owner <None|str>: Only sandboxes reserved by this user. None = the login user.
+                             'any' = any user.
+           namePattern <None|str>: Only sandbox names matching this regex. Ex: ^ci-.*
+           sandboxType <None|str>: regular|child. None = any type.
+           olderThan <None|int>: Only sandboxes reserved more than this many seconds ago.
+           parallel <int>: How many sandboxes to release at the same time.
+           dryRun <bool>: True = only report the matching sandboxes. Don't release them.
+
+        Usage example:
+           # Release the CI sandboxes of the login user that were reserved more than 6 hours ago
+           results = obj.sweepReservations(namePattern='^ci-', olderThan=6*3600, parallel=8)
+
+        Return
+           A list of results, one for each matching sandbox:
+           [{'sandbox': 'ci-sandbox-1', 'type': 'regular', 'owner': 'ciUser', 'reserveTime': 1617067828.0,
+             'age': 25000.0, 'status': 'released|dryRun|failed', 'error': None, 'duration': 1.2}]
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if owner is None:
+            owner = self.user
+
+        topologyList = self.getTopologies(name=namePattern, fieldsToFetch=['name', 'type', 'reservationDetails'])
+        now = time.time()
+
+        matches = []
+        # The reserved topologies that the owner or olderThan filter can't be applied to
+        noOwner = []
+        noReserveTime = []
+        for topology in topologyList:
+            reservationDetails = topology.get('reservationDetails') or {}
+            if reservationDetails.get('reservationStatus') != 'reserved':
+                continue
+
+            if namePattern and not re.search(namePattern, topology['name']):
+                continue
+
+            if sandboxType and topology.get('type') != sandboxType:
+                continue
+
+            reservedBy = getReservationField(reservationDetails, reservationOwnerFields)
+            if owner != 'any' and reservedBy is None:
+                noOwner.append(topology['name'])
+
+            if owner != 'any' and reservedBy != owner:
+                continue
+
+            reserveTime = parseTimestamp(getReservationField(reservationDetails, reservationTimeFields))
+            if olderThan is not None and reserveTime is None:
+                noReserveTime.append(topology['name'])
+
+            age = now - reserveTime if reserveTime is not None else None
+            if olderThan is not None and (age is None or age < olderThan):
+                continue
+
+            matches.append({'sandbox': topology['name'], 'type': topology.get('type'), 'owner': reservedBy,
+                            'reserveTime': reserveTime, 'age': age, 'status': None, 'error': None,
+                            'duration': None})
+
+        if noOwner:
+            self.logError('sweepReservations: Warning: {} reserved topologies have none of the owner fields {} in their reservationDetails and were skipped. Use owner="any" to include them: {}'.format(
+                len(noOwner), reservationOwnerFields, noOwner))
+
+        if noReserveTime:
+            self.logError('sweepReservations: Warning: {} reserved topologies have no readable reserve time in the fields {} of their reservationDetails and were skipped by olderThan: {}'.format(
+                len(noReserveTime), reservationTimeFields, noReserveTime))
+
+        self.logInfo('sweepReservations: {} of {} topologies match. dryRun={}'.format(
+            len(matches), len(topologyList), dryRun))
+
+        def sweep(result):
+            if dryRun:
+                result['status'] = 'dryRun'
+                return result
+
+            startTime = time.perf_counter()
+            try:
+                self.releaseSandbox(result['sandbox'])
+                result['status'] = 'released'
+            except Exception as errMsg:
+                result['status'] = 'failed'
+                result['error'] = str(errMsg)
+
+            result['duration'] = round(time.perf_counter() - startTime, 3)
+            return result
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return list(executor.map(sweep, matches))
+
+    def listMyReservations(self):
+        """
+        List the reservations made by reserve() for this controller and user that
+        haven't been released by release(). Reads the state file.
+
+        Return
+           A list of reservations, oldest first:
+           [{'controllerIp': '10.10.10.2', 'user': 'admin', 'sandbox': 'myBlueprint',
+             'reservedSandbox': 'myBlueprint-child-1', 'blueprintChild': 'myBlueprint-child-1',
+             'reserveTime': 1617067828.0}]
+        """
+        if self.reservationState is None:
+            return []
+
+        return [reservation for reservation in self.reservationState.load()
+                if reservation['controllerIp'] == self.controllerIp and reservation['user'] == self.user]
 
     def runSuite(self, suiteName):
         """
@@ -320,15 +864,16 @@ class Controller:
         Parameter
            suiteName <str>: The suite name to run
         """
-        self.logInfo('runSuite: sandbox:{}  suiteName:{}'.format(self.sandbox, suiteName))
-        url = '/tokalabs/api/topology/{}/run/suite/suite={}/user={}/token={}'.format(self.sandbox, suiteName,
-                                                                                     self.user, self.webToken)
+        self.logInfo('runSuite: sandbox:{}  suiteName:{}'.format(self.sandboxName, suiteName))
+        self.connectIfNeeded()
+        url = '/tokalabs/api/topology/{}/run/suite/suite={}/user={}/token={}'.format(self.sandboxName, suiteName,
+                                                                                     self.user, self.webtoken)
 
-        response = self.sendRest('get', url)
-        self.logInfo('runSuite response status: {}'.format(response.json()))
+        result = self.sendRest('get', url).json()
+        self.logInfo('runSuite response status: {}'.format(result))
 
-        if response.json()['status'] != 'Suite Started':
-            raise SdloAssistantException('{}: suiteName:{}'.format(response.json()['status'], suiteName))
+        if result['status'] != 'Suite Started':
+            raise SdloAssistantException('{}: suiteName:{}'.format(result['status'], suiteName))
         else:
             self.logInfo('Run suite successfully started: {}'.format(suiteName))
 
@@ -341,12 +886,12 @@ class Controller:
 
         # This block of code waits and verifies that all the devices are indeed reserved.
         for device in allDevices:
-            result = self. getDeviceDetails(device['name'])
+            result = self.getDeviceDetails(device['name'], fieldsToFetch=['deviceType'])
             if result['devicesList'][0]['deviceType'] == 'Ixia':
                 continue
 
             while True:
-                result = self. getDeviceDetails(device['name'])
+                result = self.getDeviceDetails(device['name'], fieldsToFetch=['reservationDetails'])
                 status = result['devicesList'][0]['reservationDetails']['reservationStatus']
                 self.logInfo('device reservation status:{}  status:{}'.format(device['name'], status ))
                 if status != 'reserved':
@@ -361,8 +906,9 @@ class Controller:
         Parameter
            suiteName <str>: The suite name to wait for
         """
+        self.connectIfNeeded()
         url = '/tokalabs/api/topology/{}/status/suite/suite={}/user={}/token={}'.format(
-            self.sandbox, suiteName, self.user, self.webToken)
+            self.sandboxName, suiteName, self.user, self.webtoken)
 
         while True:
             response = self.sendRest('get', url)
@@ -379,29 +925,34 @@ class Controller:
         """
         Get all the child sandboxes of a blueprint
         """
-        return self.getSandboxDetails()['childTopologies']
+        return self.getSandboxDetails(fieldsToFetch=['name', 'childTopologies'])['childTopologies']
 
-    def getSandboxDetails(self):
+    def getSandboxDetails(self, fieldsToFetch=None):
         """
         Get the sandbox details
+
+        Parameter
+           fieldsToFetch <None|str|list>: Only get these sandbox fields. None = all fields.
+                                          The name field is always fetched.
         """
-        url = '/tokalabs/api/topologies?name={}'.format(self.sandbox)
-        response = self.sendRest('get', url)
+        if fieldsToFetch and 'name' not in fieldsToFetch:
+            fieldsToFetch = ['name'] + list(fieldsToFetch)
 
-        for device in response.json()['additionalDetails']['topologiesList']:
-            if device['name'] == self.sandbox:
+        for device in self.getTopologies(name=exactNamePattern(self.sandboxName), fieldsToFetch=fieldsToFetch):
+            if device['name'] == self.sandboxName:
                 return device
 
-    def getAllSandboxDetails(self):
+    def getAllSandboxDetails(self, fieldsToFetch=None):
         """
         Get all of the sandbox details
+
+        Parameter
+           fieldsToFetch <None|str|list>: Only get these sandbox fields. None = all fields.
         """
-        url = '/tokalabs/api/topologies'
-        response = self.sendRest('get', url)
-        return response.json()['additionalDetails']['topologiesList']
+        return self.getTopologies(fieldsToFetch=fieldsToFetch)
 
     def getSandboxType(self):
-        return self.getSandboxDetails()['type']
+        return self.getSandboxDetails(fieldsToFetch=['name', 'type'])['type']
 
     def getSandboxDevices(self):
         """
@@ -418,16 +969,14 @@ class Controller:
              {'abstractId': 'DUT2', 'name': 'IxNetworkWebAPI'}},
             ]
         """
-        #url = '/tokalabs/api/topologies?name=%s' % (self.sandbox)
-        url = '/tokalabs/api/topologies?name=^{}$&fieldsToFetch=devices'.format(self.sandbox)
-        response = self.sendRest('get', url)
+        topologyList = self.getTopologies(name=exactNamePattern(self.sandboxName), fieldsToFetch=['devices'])
 
-        if len(response.json()['additionalDetails']['topologiesList']) == 1:
+        if len(topologyList) == 1:
             # Blueprint
-            return response.json()['additionalDetails']['topologiesList'][0]['devices']
+            return topologyList[0]['devices']
         else:
             # Regular
-            return response.json()['additionalDetails']['topologiesList'][1]['devices']
+            return topologyList[1]['devices']
 
     def getInstantiatedVmName(self, vmProfileName):
         """
@@ -439,13 +988,69 @@ class Controller:
         Chop up the vmProfileName and get the 11 characters to look up
         the sandbox devices.
 
+        To look up many VM profile names, use getInstantiatedVmNames().
+
         Return
            The instantiated VM name | None
         """
-        elevenCharacters = vmProfileName[:11]
-        for device in self.getSandboxDevices():
-            if bool(re.search('AutoVM-{}*-*'.format(elevenCharacters), device['name'])):
-                return device['name']
+        return self.getInstantiatedVmNames([vmProfileName], onAmbiguous='first')[vmProfileName]
+
+    def getInstantiatedVmNames(self, vmProfileNames, onAmbiguous='raise', devices=None):
+        """
+        Look up the instantiated VM names of many VM profiles with one sandbox query.
+
+        Instantiated VM names are in format AutoVM-<prefix>-<suffix> where the prefix is
+        the first 11 characters of the VM profile name:
+            {'name': 'AutoVM-cumulusProf-XqJWdN', 'abstractId': 'DUT1'}
+
+        Parameters
+           vmProfileNames <list>: The VM profile names in the sandbox
+           onAmbiguous <str>: What to do if more than one VM has the same prefix.
+                              raise: Raise an exception naming the VMs.
+                              first: Use the first VM in the sandbox device order, like
+                                     getInstantiatedVmName() always did.
+                              all:   Return the list of all the VM names for that profile
+                                     in the sandbox device order.
+           devices <None|list>: The sandbox devices from getSandboxDevices().
+                                None = get the sandbox devices.
+
+        Return
+           A dict: {vmProfileName: instantiated VM name | None}
+           With onAmbiguous='all', the values are lists of VM names.
+        """
+        if onAmbiguous not in ['raise', 'first', 'all']:
+            raise SdloAssistantException('onAmbiguous must be raise|first|all: {}'.format(onAmbiguous))
+
+        if devices is None:
+            devices = self.getSandboxDevices()
+
+        # {prefix: [instantiated VM names]}
+        vmIndex = {}
+        for device in devices:
+            if not device['name'].startswith('AutoVM-'):
+                continue
+
+            prefix, separator, suffix = device['name'][len('AutoVM-'):].rpartition('-')
+            if separator:
+                vmIndex.setdefault(prefix, []).append(device['name'])
+
+        vmNames = {}
+        for vmProfileName in vmProfileNames:
+            # In the sandbox device order
+            matches = vmIndex.get(vmProfileName[:11], [])
+
+            if onAmbiguous == 'all':
+                vmNames[vmProfileName] = matches
+                continue
+
+            if len(matches) > 1 and onAmbiguous == 'raise':
+                raise SdloAssistantException('VM profile "{}" matches more than one VM in sandbox {}: {}'.format(
+                    vmProfileName, self.sandboxName, matches))
+
+            vmNames[vmProfileName] = matches[0] if matches else None
+
+        self.logInternal('getInstantiatedVmNames: {}'.format(vmNames))
+        return vmNames
 
     def getResults(self):
         """
@@ -461,9 +1066,8 @@ class Controller:
 
         Returns: Passed|Failed
         """
-        url = '/testrunner/{}/TestControl.php?task=2'.format(self.sandbox)
-        response = self.sendRest('get', url)
-        if response.json()['casesFailed'] != '0' or response.json()['stepsFailed'] != '0':
+        result = self.getLatestResults()
+        if result['casesFailed'] != '0' or result['stepsFailed'] != '0':
             self.logError('Test result: Failed')
             return 'Failed'
         else:
@@ -483,30 +1087,100 @@ class Controller:
 
         Returns: All results
         """
-        url = '/testrunner/{}/TestControl.php?task=2'.format(self.sandbox)
-        response = self.sendRest('get', url)
+        from pprint import pprint
+
+        result = self.getLatestResults()
         print()
-        pprint(response.json())
+        pprint(result)
         print()
 
-        return response.json()
+        return result
+
+    def getLatestResults(self):
+        """
+        Get the results of the latest run without logging them.
+        To keep a history of the results, see sdloResults.ResultsStore.
 
-    def getDeviceDetails(self, deviceHostname):
+        Returns: The results dict. See showResults().
+        """
+        url = '/testrunner/{}/TestControl.php?task=2'.format(self.sandboxName)
+        return self.sendRest('get', url).json()
+
+    def getDeviceDetails(self, deviceHostname, fieldsToFetch=None):
         """
         Get the device details
+
+        Parameters
+           deviceHostname <str>: The device name
+           fieldsToFetch <None|str|list>: Only get these device fields. None = all fields.
+                                          Ex: ['deviceType', 'reservationDetails']
         """
         url = '/tokalabs/api/devices?hostname=^{}$'.format(deviceHostname)
+        if fieldsToFetch:
+            url += '&fieldsToFetch={}'.format(joinFields(fieldsToFetch))
+
         response = self.sendRest('get', url)
         return response.json()['additionalDetails']
 
+    def iterDevices(self, fieldsToFetch=None, pageSize=200):
+        """
+        Iterate over all the devices in the inventory one page at a time so
+        only one page of devices is in memory.
+
+        Parameters
+           fieldsToFetch <None|str|list>: Only get these device fields. None = all fields.
+                                          Ex: ['hostname', 'deviceType', 'physicalPortConnections']
+           pageSize <int>: How many devices to get per query
+
+        Usage example:
+           for device in obj.iterDevices(fieldsToFetch=['hostname', 'deviceType']):
+               print(device['hostname'])
+
+        Yield
+           Each device dict of the devicesList
+        """
+        pageNum = 1
+        count = 0
+        while True:
+            url = '/tokalabs/api/devices?pageNum={}&pageSize={}'.format(pageNum, pageSize)
+            if fieldsToFetch:
+                url += '&fieldsToFetch={}'.format(joinFields(fieldsToFetch))
+
+            additionalDetails = self.sendRest('get', url).json()['additionalDetails']
+            devicesList = additionalDetails['devicesList']
+            for device in devicesList:
+                yield device
+
+            count += len(devicesList)
+            metadata = additionalDetails.get('metadata') or {}
+            totalRecords = metadata.get('totalRecords')
+
+            if not devicesList:
+                break
+
+            if totalRecords is not None:
+                # The controller may cap the page size. Page by the size it returned.
+                if count >= totalRecords:
+                    break
+
+                if metadata.get('pageSize'):
+                    pageSize = metadata['pageSize']
+
+            elif len(devicesList) < pageSize:
+                break
+
+            pageNum += 1
+
     def getVlinkConnections(self, vlinkName):
         """
         Get all the vlink connections
 
+        To get the connections of all the devices and vLinks, see sdloGraph.exportConnectionGraph().
+
         Returns
            A list of vLink connections
         """
-        vlinkConnectionList = self.getDeviceDetails(vlinkName)['devicesList'][0]['physicalPortConnections']
+        vlinkConnectionList = self.getDeviceDetails(vlinkName, fieldsToFetch=['physicalPortConnections'])['devicesList'][0]['physicalPortConnections']
         return vlinkConnectionList
 
     def isSandboxExists(self, sandboxName):
@@ -517,9 +1191,7 @@ class Controller:
            If exists, return True
            Else, return False
         """
-        url = '/tokalabs/api/topologies'
-        response = self.sendRest('get', url)
-        topologyList = response.json()['additionalDetails']['topologiesList']
+        topologyList = self.getTopologies(name=exactNamePattern(sandboxName), fieldsToFetch=['name'])
         if sandboxName in [topology['name'] for topology in topologyList]:
             return True
         else:
@@ -651,25 +1323,29 @@ class Controller:
         Return
             A dictionary of all the devices and its details
         """
+        # Build a new dict and swap it in when done so readers in other threads
+        # never see a partially filled deviceDict.
+        deviceDict = {}
         for device in self.getSandboxDevices():
             deviceName = device['name']
-            self.deviceDict[deviceName] = dict()
+            deviceDict[deviceName] = dict()
             mgmtInterfaces = []
             deviceDetails = self.getDeviceDetails(deviceName)
 
             for dev in deviceDetails['devicesList']:
                 for key,value in dev.items():
                     if isinstance(value, dict) == False:
-                        self.deviceDict[deviceName].update({key:value})
+                        deviceDict[deviceName].update({key:value})
 
                 for eachMgmtInterface in dev['deviceManagement']['managementInterfaces']:
                     mgmtInterfaces.append(eachMgmtInterface)
 
                 if 'physicalPortConnections' in dev:
-                    self.deviceDict[device['name']].update({'ports': dev['physicalPortConnections']['interfaces']})
+                    deviceDict[device['name']].update({'ports': dev['physicalPortConnections']['interfaces']})
 
-            self.deviceDict[device['name']].update({'mgmtInterfaces': mgmtInterfaces})
+            deviceDict[device['name']].update({'mgmtInterfaces': mgmtInterfaces})
 
+        self.deviceDict = deviceDict
         return self.deviceDict
 
     def addDevice(self, data):
@@ -737,8 +1413,22 @@ class Controller:
            obj.setSandbox(<sandbox_name>)
            obj.createSandboxKeywords(keywordData)
         """
-        url = '/tokalabs/api/keywords/sandbox/{}'.format(self.sandbox)
-        response = self.sendRest('post', url, keywordsData)
+        return self.postSandboxKeywords(self.sandboxName, keywordsData)
+
+    def postSandboxKeywords(self, sandbox, keywordsData):
+        """
+        Post keywords to a sandbox and drop the cached keywords of the sandbox.
+        See createSandboxKeywords() for the keywordsData format.
+        """
+        url = '/tokalabs/api/keywords/sandbox/{}'.format(sandbox)
+        try:
+            response = self.sendRest('post', url, keywordsData)
+        finally:
+            with self.lock:
+                self.keywordGenerations[sandbox] = self.keywordGenerations.get(sandbox, 0) + 1
+                for key in [key for key in self.keywordCache if key[0] == sandbox]:
+                    del self.keywordCache[key]
+
         return response.json()
         
     def getSandboxKeywords(self, executionProfile='Default'):
@@ -753,26 +1443,177 @@ class Controller:
             A dictionary of keyword/value
         """
         if executionProfile == 'Default':
-            url = f'/tokalabs/api/keywords/sandbox/{self.sandbox}'
+            url = f'/tokalabs/api/keywords/sandbox/{self.sandboxName}'
         else:
-            url = f'/tokalabs/api/keywords/sandbox/{self.sandbox}?executionProfile={executionProfile}'
+            url = f'/tokalabs/api/keywords/sandbox/{self.sandboxName}?executionProfile={executionProfile}'
 
-        response = self.sendRest('get', url)
+        result = self.sendRest('get', url).json()
 
-        if response.json()['additionalDetails'] == []:
-            self.logError(response.json()['message'])
+        if result['additionalDetails'] == []:
+            self.logError(result['message'])
             return
 
-        keywordsListRaw = response.json()['additionalDetails']['keywordsList']
+        keywordsListRaw = result['additionalDetails']['keywordsList']
         keywordsList = {}
 
         for keyword in keywordsListRaw:
-            self.logDebug(f'Keywords: {keyword}')
             keywordsList[keyword['name']] = keyword['value']
 
         self.logInfo(f'Sandbox keywords: {keywordsList}')
         return keywordsList
 
+    def fetchSandboxKeywords(self, sandbox, executionProfile='Default'):
+        """
+        Get the keywords of a sandbox execution profile from the controller without caching.
+
+        Return
+            A dict: {keywordName: {'name': ..., 'value': ..., 'dataType': ..., 'executionProfile': ...}}
+        """
+        url = f'/tokalabs/api/keywords/sandbox/{sandbox}'
+        if executionProfile != 'Default':
+            url += f'?executionProfile={executionProfile}'
+
+        result = self.sendRest('get', url).json()
+        if result['additionalDetails'] == []:
+            return {}
+
+        return {keyword['name']: keyword for keyword in result['additionalDetails']['keywordsList']}
+
+    def loadSandboxKeywords(self, executionProfiles=None, sandbox=None, refresh=False, parallel=4):
+        """
+        Get the keywords of many execution profiles of a sandbox.
+        The execution profiles are read concurrently and cached. The cache is shared
+        with the sandbox handles and dropped when keywords are posted to the sandbox.
+
+        Parameters
+           executionProfiles <None|list>: The execution profiles. None = ['Default']
+           sandbox <None|str>: The sandbox name. Defaults to the sandbox of this instance.
+           refresh <bool>: True = read the keywords from the controller even if they are cached.
+           parallel <int>: How many execution profiles to read at the same time.
+
+        Return
+           A dict: {executionProfile: {keywordName: value}}
+        """
+        if sandbox is None:
+            sandbox = self.sandboxName
+
+        return self.getKeywordsForSandboxes([sandbox], executionProfiles, refresh=refresh, parallel=parallel)[sandbox]
+
+    def getKeywordsForSandboxes(self, sandboxes, executionProfiles=None, refresh=False, parallel=4):
+        """
+        Get the keywords of many sandboxes and execution profiles in one call.
+        Uncached keywords are read concurrently. See loadSandboxKeywords().
+
+        Parameters
+           sandboxes <list>: The sandbox names
+           executionProfiles <None|list>: The execution profiles. None = ['Default']
+           refresh <bool>: True = read the keywords from the controller even if they are cached.
+           parallel <int>: How many sandbox execution profiles to read at the same time.
+
+        Return
+           A dict: {sandbox: {executionProfile: {keywordName: value}}}
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if executionProfiles is None:
+            executionProfiles = ['Default']
+
+        keys = [(sandbox, executionProfile) for sandbox in sandboxes for executionProfile in executionProfiles]
+        with self.lock:
+            toFetch = [key for key in keys if refresh or key not in self.keywordCache]
+            generations = {sandbox: self.keywordGenerations.get(sandbox, 0) for sandbox in sandboxes}
+
+        fetched = {}
+        if toFetch:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                fetched = dict(zip(toFetch, executor.map(lambda key: self.fetchSandboxKeywords(*key), toFetch)))
+
+            with self.lock:
+                # Don't cache the keywords of a sandbox that had keywords posted during the read
+                self.keywordCache.update((key, value) for key, value in fetched.items()
+                                         if self.keywordGenerations.get(key[0], 0) == generations[key[0]])
+
+        with self.lock:
+            keywords = {sandbox: {} for sandbox in sandboxes}
+            for sandbox, executionProfile in keys:
+                key = (sandbox, executionProfile)
+                keywords[sandbox][executionProfile] = {name: keyword['value'] for name, keyword in
+                                                       fetched.get(key, self.keywordCache.get(key, {})).items()}
+
+        self.logInternal('getKeywordsForSandboxes: read {} of {} execution profiles from the controller'.format(
+            len(toFetch), len(keys)))
+        return keywords
+
+    def syncSandboxKeywords(self, keywords, executionProfile='Default', sandbox=None, dataType='String'):
+        """
+        Push only the keywords that were added or changed.
+
+        Parameters
+           keywords <dict>: The keywords to set: {keywordName: value}
+           executionProfile <str>: The execution profile of the keywords
+           sandbox <None|str>: The sandbox name. Defaults to the sandbox of this instance.
+           dataType <str>: The dataType of new keywords
+
+        Usage example:
+           obj.syncSandboxKeywords({'ixNetApiServerDeviceName': 'IxNetworkAPIServer',
+                                    'forceTakeSandboxOwnership': 'True'})
+
+        Return
+           A list of the keyword names that were pushed
+        """
+        if sandbox is None:
+            sandbox = self.sandboxName
+
+        self.getKeywordsForSandboxes([sandbox], [executionProfile])
+        with self.lock:
+            # Not cached if keywords were posted during the read. Then every keyword is pushed.
+            current = dict(self.keywordCache.get((sandbox, executionProfile), {}))
+
+        keywordsList = []
+        for name, value in keywords.items():
+            if name in current and current[name]['value'] == value:
+                continue
+
+            keywordsList.append({'name': name, 'value': value,
+                                 'dataType': current[name].get('dataType', dataType) if name in current else dataType,
+                                 'executionProfile': executionProfile})
+
+        if keywordsList:
+            self.postSandboxKeywords(sandbox, {'keywordsList': keywordsList})
+
+        pushed = [keyword['name'] for keyword in keywordsList]
+        self.logInfo('Sandbox {} keywords pushed: {}  unchanged: {}'.format(sandbox, pushed,
+                                                                          len(keywords) - len(pushed)))
+        return pushed
+
+    def syncKeywordsForSandboxes(self, keywordsBySandbox, executionProfile='Default', parallel=4):
+        """
+        Push the added or changed keywords of many sandboxes in one call.
+        See syncSandboxKeywords().
+
+        Parameters
+           keywordsBySandbox <dict>: {sandbox: {keywordName: value}}
+           executionProfile <str>: The execution profile of the keywords
+           parallel <int>: How many sandboxes to sync at the same time.
+
+        Return
+           A dict: {sandbox: {'pushed': [keyword names], 'error': None|<error message>}}
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        sandboxes = list(keywordsBySandbox)
+
+        def sync(sandbox):
+            try:
+                return {'pushed': self.syncSandboxKeywords(keywordsBySandbox[sandbox], executionProfile,
+                                                           sandbox=sandbox),
+                        'error': None}
+            except Exception as errMsg:
+                return {'pushed': [], 'error': str(errMsg)}
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return dict(zip(sandboxes, executor.map(sync, sandboxes)))
+
     def addVCenter(self, vcenterName, ipAddress, username, password):
         """
         Create a vCenter profile
@@ -782,6 +1623,9 @@ class Controller:
            ipAddress <str>: The vCenter IP address
            username <str>: The vCenter login username
            password <str>: The vCenter login password
+
+        Return
+           The controller response
         """
         data = {'hostname': vcenterName,
                 'assetID': '',
@@ -800,7 +1644,7 @@ class Controller:
                 }}
 
         url = '/tokalabs/api/devices/vmware/vcenter/'
-        self.sendRest('post', url, data)
+        return self.sendRest('post', url, data).json()
         
     def addVMAsDeviceFromVCenter(self, vmName, vCenterProfile, protocolType='ssh', networkPort='',
                          username='admin', password='admin', data=None):
@@ -808,6 +1652,10 @@ class Controller:
         Add a VM from vCenter as a device in inventory.
 
         Either provide your own data or use the API parameters to create a basic VM device.
+        The management IP is fetched with VMware tools. See provisionVMs() to wait for it.
+
+        Return
+           The controller response
         """
         if data is None:
             data = {"hostname": vmName,
@@ -835,7 +1683,7 @@ class Controller:
                     }}
         
         url = '/tokalabs/api/devices/vmware/vm/'
-        self.sendRest('post', url, data)
+        return self.sendRest('post', url, data).json()
 
     def connectDevicePorts(self, srcDeviceName, targetDeviceName, srcPortId, targetPortId):
         """
@@ -879,27 +1727,167 @@ class Controller:
             "notes": "Reservation Notes",
             "oppId": "Sample opportunity id"
         }
+
+        Return
+           The controller response
         """
-        if self.sandbox == None and sandbox == None:
+        if self.sandboxName == None and sandbox == None:
             raise SdloAssistantException('You must provide a sandbox name')
 
-        if self.sandbox:
-            sandbox = self.sandbox
+        if sandbox is None:
+            sandbox = self.sandboxName
             
         url = '/tokalabs/api/sandbox/reservations'
         params = {
             "sandbox": sandbox,
-            "executionProfile": exceutionProfile,
+            "executionProfile": executionProfile,
             "start": start,
             "end": end,
             "user": user,
             "notes": notes
         }
         
-        self.sendRest('post', url, params)
+        response = self.sendRest('post', url, params)
+        return response.json()
+
+    def getCalendarReservations(self, sandbox=None):
+        """
+        Get the calendar reservations of a sandbox
+
+        Parameter
+           sandbox <None|str>: The sandbox name. Defaults to the sandbox of this instance.
+
+        Return
+           A list of reservations. Each reservation has the same fields as configCalendarReservation():
+           [{'sandbox': 'TrafficTest', 'user': 'jsmith', 'start': 1589992938, 'end': 1589996538, ...}]
+        """
+        if sandbox is None:
+            sandbox = self.sandboxName
+
+        url = '/tokalabs/api/sandbox/reservations?sandbox={}'.format(sandbox)
+        reservations = self.sendRest('get', url).json()['additionalDetails']
+
+        if isinstance(reservations, dict):
+            reservations = reservations.get('reservationsList', [])
+
+        return [reservation for reservation in reservations if reservation.get('sandbox', sandbox) == sandbox]
+
+    def getReservationCalendar(self, sandboxes, parallel=4):
+        """
+        Get the calendar reservations of many sandboxes once and index them.
+
+        Parameters
+           sandboxes <list>: The sandbox names
+           parallel <int>: How many sandboxes to query at the same time
+
+        Return
+           A ReservationCalendar object
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            reservations = dict(zip(sandboxes, executor.map(self.getCalendarReservations, sandboxes)))
+
+        return ReservationCalendar(reservations)
+
+    def findCalendarSlot(self, sandboxes, duration, earliest=None, latest=None, calendar=None):
+        """
+        Find the earliest time window that is free in all of the sandboxes.
+
+        Parameters
+           sandboxes <list>: The sandbox names
+           duration <int>: The length of the window in seconds
+           earliest <None|int>: Epoch seconds. Don't start before this time. Defaults to now.
+           latest <None|int>: Epoch seconds. The window must end by this time. None = no limit.
+           calendar <None|ReservationCalendar>: Reuse a calendar from getReservationCalendar().
+                                                 None = get the sandbox reservations.
+
+        Usage example:
+           # Find 2 hours in three sandboxes within the next week
+           now = int(time.time())
+           start, end = obj.findCalendarSlot(['sandbox1', 'sandbox2', 'sandbox3'], 7200,
+                                             earliest=now, latest=now+7*24*3600)
+
+        Return
+           (start, end) in epoch seconds | None if there is no such window
+        """
+        if calendar is None:
+            calendar = self.getReservationCalendar(sandboxes)
+
+        return calendar.findFreeWindow(sandboxes, duration, earliest=earliest, latest=latest)
+
+    def bookCalendarReservations(self, reservations, calendar=None, parallel=4):
+        """
+        Book many calendar reservations.
+
+        Each reservation is checked against the existing reservations and the reservations
+        booked before it in the list. Conflicting reservations are not sent to the controller.
+
+        Parameters
+           reservations <list>: A list of dicts with the configCalendarReservation() parameters.
+                                [{'sandbox': 'sandbox1', 'start': 1589992938, 'end': 1589996538,
+                                  'user': 'jsmith', 'executionProfile': 'Default', 'notes': None}]
+           calendar <None|ReservationCalendar>: Reuse a calendar from getReservationCalendar().
+                                                 None = get the reservations of the sandboxes.
+           parallel <int>: How many reservations to post at the same time
+
+        Return
+           A list of results in the same order as the reservations:
+           [{'sandbox': 'sandbox1', 'start': ..., 'end': ..., 'user': 'jsmith',
+             'status': 'booked|conflict|failed', 'conflicts': [<reservation>], 'error': None}]
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if calendar is None:
+            calendar = self.getReservationCalendar(sorted(set(eachReservation['sandbox']
+                                                              for eachReservation in reservations)))
+
+        results = []
+        toBook = []
+        for reservation in reservations:
+            result = {'sandbox': reservation['sandbox'], 'start': reservation['start'], 'end': reservation['end'],
+                      'user': reservation.get('user'), 'status': None, 'conflicts': [], 'error': None}
+            results.append(result)
+
+            conflicts = calendar.conflicts(reservation['sandbox'], reservation['start'], reservation['end'])
+            if conflicts:
+                result['status'] = 'conflict'
+                result['conflicts'] = conflicts
+                continue
+
+            # Hold the time so later reservations in the list see it
+            calendar.add(reservation)
+            toBook.append((reservation, result))
+
+        def book(reservationAndResult):
+            reservation, result = reservationAndResult
+            try:
+                self.configCalendarReservation(sandbox=reservation['sandbox'], start=reservation['start'],
+                                               end=reservation['end'], user=reservation.get('user'),
+                                               executionProfile=reservation.get('executionProfile', 'Default'),
+                                               notes=reservation.get('notes'))
+                result['status'] = 'booked'
+            except Exception as errMsg:
+                result['status'] = 'failed'
+                result['error'] = str(errMsg)
+                calendar.remove(reservation)
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            list(executor.map(book, toBook))
+
+        for result in results:
+            if result['status'] == 'booked':
+                self.logInfo('Booked sandbox {}: {} - {}'.format(result['sandbox'], result['start'], result['end']))
+            else:
+                self.logError('Booking sandbox {} {}: {} - {} {}'.format(result['sandbox'], result['status'],
+                                                                        result['start'], result['end'],
+                                                                        result['error'] or result['conflicts']))
+
+        return results
         
     def createVMwareProfile(self, vmProfileName, vCenterProfile, protocolType='ssh',
-                            username='admin', password='admin', webOptions=None, data=None):
+                            username='admin', password='admin', webOptions=None, data=None,
+                            source='devOpsServer-1.0.0 Template', networkPort=1234):
         """
         Create a VMware Profile. This creates a clone of a VM or a template from vCenter.
         Either pass in your own data or create a basic VM profile using all the parameters
@@ -907,6 +1895,12 @@ class Controller:
 
         To include web options, pass in a list:
            webOption = [{"name": "woption1", "command": ["line1", "line2"]}] 
+
+        source <str>: The vCenter VM or template to clone
+        networkPort <int>: The management interface port
+
+        Return
+           The controller response
         """
         if webOptions is None:
             webOptions = []
@@ -915,7 +1909,7 @@ class Controller:
             data = {"hostname": vmProfileName,
                     "vcenter": vCenterProfile,
                     #"sourceType": "template", 
-                    "source": "devOpsServer-1.0.0 Template",   
+                    "source": source,
                     #"locationId": '',
                     "reservable": False, 
                     "deviceManagement": { 
@@ -925,8 +1919,8 @@ class Controller:
                             { 
                                 "managementType": "primary", 
                                 "enabled": True, 
-                                "type": "ssh", 
-                                "networkPort": 1234, 
+                                "type": protocolType,
+                                "networkPort": networkPort,
                                 "authType": "password", 
                                 "username": username, 
                                 "password": password, 
@@ -945,11 +1939,457 @@ class Controller:
             } 
             
         url = '/tokalabs/api/devices/vmware/vmprofile/'
-        self.sendRest('post', url, data)
+        return self.sendRest('post', url, data).json()
+
+    def getDevicesByName(self, deviceNames, fieldsToFetch=None, chunkSize=50):
+        """
+        Get the details of many devices with one query per chunkSize devices.
+
+        Parameters
+           deviceNames <list>: The device hostnames
+           fieldsToFetch <None|str|list>: Only get these device fields. None = all fields.
+           chunkSize <int>: How many device names to put in one query
+
+        Return
+           The devicesList of all the devices found
+        """
+        from urllib.parse import quote
+
+        devicesList = []
+        for index in range(0, len(deviceNames), chunkSize):
+            chunk = deviceNames[index:index+chunkSize]
+            hostnamePattern = '^({})$'.format('|'.join(re.escape(name) for name in chunk))
+            url = '/tokalabs/api/devices?hostname={}'.format(quote(hostnamePattern, safe=''))
+            if fieldsToFetch:
+                url += '&fieldsToFetch={}'.format(joinFields(fieldsToFetch))
+
+            devicesList.extend(self.sendRest('get', url).json()['additionalDetails']['devicesList'])
+
+        return devicesList
+
+    def provisionVMs(self, vmSpecs, parallel=4, timeout=900, pollInterval=10):
+        """
+        Create VMware profiles and VM devices concurrently, then wait for the VM devices
+        to get their management IP from VMware tools.
+
+        All the VMs are polled together with one device query per poll (see getDevicesByName()).
+
+        Parameters
+           vmSpecs <list>: A list of dicts. Each dict creates a VM device, a VMware profile or both.
+                           VM device: vmName, vCenterProfile, and optional protocolType, networkPort,
+                                      username, password. See addVMAsDeviceFromVCenter().
+                           VMware profile: vmProfileName, vCenterProfile, and optional source,
+                                           protocolType, networkPort, username, password, webOptions.
+                                           See createVMwareProfile().
+           parallel <int>: How many specs to create at the same time
+           timeout <int>: Seconds to wait for all the VM devices to get a management IP
+           pollInterval <int>: Seconds between polls
+
+        Usage example:
+           vmSpecs = [{'vmName': 'vm{}'.format(index), 'vCenterProfile': 'myVCenter'} for index in range(40)]
+           results = obj.provisionVMs(vmSpecs, parallel=8)
+
+        Return
+           A dict keyed by the vmName or else the vmProfileName of each spec:
+           {'vm1': {'status': 'ready|created|failed|timeout', 'ip': '10.10.10.21', 'error': None,
+                    'createTime': 2.1, 'readyTime': 95.3}}
+           createTime and readyTime are seconds since provisionVMs() started.
+           Specs that only create a VMware profile end with status created.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        optionalArgs = ['protocolType', 'networkPort', 'username', 'password']
+        startTime = time.perf_counter()
+
+        def create(vmSpec):
+            name = vmSpec.get('vmName') or vmSpec['vmProfileName']
+            result = {'status': 'created', 'ip': None, 'error': None, 'createTime': None, 'readyTime': None}
+            try:
+                if vmSpec.get('vmProfileName'):
+                    profileArgs = {key: vmSpec[key] for key in optionalArgs + ['source', 'webOptions'] if key in vmSpec}
+                    self.createVMwareProfile(vmSpec['vmProfileName'], vmSpec['vCenterProfile'], **profileArgs)
+
+                if vmSpec.get('vmName'):
+                    vmArgs = {key: vmSpec[key] for key in optionalArgs if key in vmSpec}
+                    self.addVMAsDeviceFromVCenter(vmSpec['vmName'], vmSpec['vCenterProfile'], **vmArgs)
+
+            except Exception as errMsg:
+                result['status'] = 'failed'
+                result['error'] = str(errMsg)
+
+            result['createTime'] = round(time.perf_counter() - startTime, 3)
+            return name, result
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = dict(executor.map(create, vmSpecs))
+
+        pending = [vmSpec['vmName'] for vmSpec in vmSpecs
+                   if vmSpec.get('vmName') and results[vmSpec['vmName']]['status'] == 'created']
+        self.logInfo('provisionVMs: created {} of {}. Waiting for {} VM IPs'.format(
+            len([result for result in results.values() if result['status'] == 'created']), len(vmSpecs), len(pending)))
+
+        while pending:
+            try:
+                devicesList = self.getDevicesByName(pending, fieldsToFetch=['hostname', 'deviceManagement'])
+            except Exception as errMsg:
+                self.logError('provisionVMs: polling the VM devices failed: {}'.format(errMsg))
+                devicesList = []
+
+            for device in devicesList:
+                if device.get('hostname') not in pending:
+                    continue
+
+                for mgmtInterface in device.get('deviceManagement', {}).get('managementInterfaces', []):
+                    if mgmtInterface.get('networkAddress') not in [None, '', '1.1.1.1', '0.0.0.0']:
+                        result = results[device['hostname']]
+                        result['status'] = 'ready'
+                        result['ip'] = mgmtInterface['networkAddress']
+                        result['readyTime'] = round(time.perf_counter() - startTime, 3)
+                        pending.remove(device['hostname'])
+                        break
+
+            if not pending:
+                break
+
+            if time.perf_counter() - startTime + pollInterval > timeout:
+                for vmName in pending:
+                    results[vmName]['status'] = 'timeout'
+                    results[vmName]['error'] = 'No management IP after {} seconds'.format(timeout)
+                break
+
+            self.logInternal('provisionVMs: waiting for {} VM IPs'.format(len(pending)))
+            time.sleep(pollInterval)
+
+        self.logInfo('provisionVMs: {}'.format({status: len([result for result in results.values()
+                                                             if result['status'] == status])
+                                                for status in ['ready', 'created', 'failed', 'timeout']}))
+        return results
+
+
+class ReservationState:
+    """
+    Keeps the reservations made by reserve() in a JSON file so release() from another process
+    knows which sandbox to release.
+
+    Each change reads, updates and rewrites the file while holding an exclusive lock on
+    <stateFile>.lock. The file is replaced atomically so readers never see a partial file.
+    """
+    def __init__(self, stateFile):
+        self.stateFile = stateFile
+        self.lock = threading.Lock()
+
+    def locked(self):
+        """
+        Return a context manager that holds the lock of the state file
+        """
+        import contextlib
+
+        @contextlib.contextmanager
+        def lockFile():
+            os.makedirs(os.path.dirname(os.path.abspath(self.stateFile)), exist_ok=True)
+            with self.lock, open(self.stateFile + '.lock', 'a') as lockFileObj:
+                try:
+                    import fcntl
+                except ImportError:
+                    # No file locking on this platform. Only threads are serialized.
+                    fcntl = None
+
+                if fcntl:
+                    fcntl.flock(lockFileObj, fcntl.LOCK_EX)
+
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lockFileObj, fcntl.LOCK_UN)
+
+        return lockFile()
+
+    def load(self):
+        """
+        Return the list of reservations
+        """
+        import json
+
+        if not os.path.exists(self.stateFile):
+            return []
+
+        with open(self.stateFile) as stateFileObj:
+            try:
+                return json.load(stateFileObj)
+            except ValueError:
+                return []
+
+    def save(self, reservations):
+        import json
+
+        tempFile = '{}.{}.tmp'.format(self.stateFile, os.getpid())
+        with open(tempFile, 'w') as stateFileObj:
+            json.dump(reservations, stateFileObj, indent=2)
+
+        os.replace(tempFile, self.stateFile)
+
+    def add(self, reservation):
+        with self.locked():
+            reservations = [eachReservation for eachReservation in self.load()
+                            if (eachReservation['controllerIp'], eachReservation['reservedSandbox']) !=
+                               (reservation['controllerIp'], reservation['reservedSandbox'])]
+            reservations.append(reservation)
+            self.save(reservations)
+
+    def remove(self, controllerIp, reservedSandbox):
+        with self.locked():
+            reservations = self.load()
+            remaining = [reservation for reservation in reservations
+                         if (reservation['controllerIp'], reservation['reservedSandbox']) != (controllerIp, reservedSandbox)]
+
+            if len(remaining) != len(reservations):
+                self.save(remaining)
+
+    def find(self, controllerIp, user, sandbox):
+        """
+        Find the reservations of a sandbox, or of a blueprint by its name.
+        A blueprint can have more than one reserved child.
+
+        Return
+           A list of reservation dicts, oldest first
+        """
+        matches = [reservation for reservation in self.load()
+                   if reservation['controllerIp'] == controllerIp and reservation['user'] == user and
+                   sandbox in [reservation['sandbox'], reservation['reservedSandbox']]]
+
+        return sorted(matches, key=lambda reservation: reservation['reserveTime'])
+
+
+class IntervalTree:
+    """
+    An interval tree of half-open [start, end) intervals.
+
+    The intervals are kept sorted by start and the tree is an implicit balanced binary
+    tree over that list: the middle interval of a range is the root of the range.
+    Each node keeps the max end of its subtree so overlap queries skip the subtrees
+    that end before the query starts. The max ends are rebuilt on the first query
+    after intervals are added or removed.
+    """
+    def __init__(self, intervals=None):
+        """
+        Parameter
+           intervals <None|list>: A list of (start, end, data)
+        """
+        self.intervals = sorted(intervals or [], key=lambda interval: interval[:2])
+        self.maxEnd = []
+        self.isDirty = True
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+    def add(self, start, end, data=None):
+        import bisect
+
+        index = bisect.bisect_right([interval[:2] for interval in self.intervals], (start, end))
+        self.intervals.insert(index, (start, end, data))
+        self.isDirty = True
+
+    def remove(self, start, end, data=None):
+        self.intervals.remove((start, end, data))
+        self.isDirty = True
+
+    def build(self, low, high):
+        if low >= high:
+            return float('-inf')
+
+        middle = (low + high) // 2
+        self.maxEnd[middle] = max(self.intervals[middle][1], self.build(low, middle), self.build(middle + 1, high))
+        return self.maxEnd[middle]
+
+    def overlaps(self, start, end):
+        """
+        Get the intervals that overlap [start, end)
+
+        Return
+           A list of (start, end, data) sorted by start
+        """
+        if self.isDirty:
+            self.maxEnd = [None] * len(self.intervals)
+            self.build(0, len(self.intervals))
+            self.isDirty = False
+
+        found = []
+        self.search(0, len(self.intervals), start, end, found)
+        return found
+
+    def search(self, low, high, start, end, found):
+        if low >= high:
+            return
+
+        middle = (low + high) // 2
+        if self.maxEnd[middle] <= start:
+            # Everything in this subtree ends before the query starts
+            return
+
+        self.search(low, middle, start, end, found)
+
+        intervalStart, intervalEnd, data = self.intervals[middle]
+        if intervalStart < end:
+            if intervalEnd > start:
+                found.append(self.intervals[middle])
+
+            # The right subtree starts at or after intervalStart
+            self.search(middle + 1, high, start, end, found)
+
+
+class ReservationCalendar:
+    """
+    The calendar reservations of a set of sandboxes indexed in an interval tree per sandbox.
+    Created by Controller.getReservationCalendar().
+    """
+    def __init__(self, reservations):
+        """
+        Parameter
+           reservations <dict>: {sandboxName: [reservation, ...]}
+                                Each reservation has at least a start and an end in epoch seconds.
+        """
+        self.trees = {}
+        for sandbox, sandboxReservations in reservations.items():
+            self.trees[sandbox] = IntervalTree([(int(reservation['start']), int(reservation['end']),
+                                                 ReservationKey(reservation))
+                                                for reservation in sandboxReservations])
+
+    def add(self, reservation):
+        self.trees.setdefault(reservation['sandbox'], IntervalTree()).add(
+            int(reservation['start']), int(reservation['end']), ReservationKey(reservation))
+
+    def remove(self, reservation):
+        self.trees[reservation['sandbox']].remove(int(reservation['start']), int(reservation['end']),
+                                                   ReservationKey(reservation))
+
+    def conflicts(self, sandbox, start, end):
+        """
+        Get the reservations of a sandbox that overlap [start, end)
+        """
+        if sandbox not in self.trees:
+            return []
+
+        return [data.reservation for intervalStart, intervalEnd, data in self.trees[sandbox].overlaps(start, end)]
+
+    def isFree(self, sandbox, start, end):
+        return self.conflicts(sandbox, start, end) == []
+
+    def findFreeWindow(self, sandboxes, duration, earliest=None, latest=None):
+        """
+        Find the earliest window of duration seconds that is free in all of the sandboxes.
+
+        Return
+           (start, end) in epoch seconds | None
+        """
+        import heapq
+
+        if earliest is None:
+            earliest = int(time.time())
+
+        candidate = earliest
+        # Sweep the reservations of all the sandboxes in start order
+        for intervalStart, intervalEnd, data in heapq.merge(*[self.trees.get(sandbox, IntervalTree())
+                                                              for sandbox in sandboxes],
+                                                            key=lambda interval: interval[:2]):
+            if intervalEnd <= candidate:
+                continue
+
+            if intervalStart - candidate >= duration:
+                break
+
+            candidate = max(candidate, intervalEnd)
+
+        if latest is not None and candidate + duration > latest:
+            return None
+
+        return (candidate, candidate + duration)
+
+
+class ReservationKey:
+    """
+    Wraps a reservation dict so it can be stored and compared in an IntervalTree
+    """
+    def __init__(self, reservation):
+        self.reservation = reservation
+
+    def __eq__(self, other):
+        return isinstance(other, ReservationKey) and self.reservation == other.reservation
+
+
+class RestResponse:
+    """
+    Wraps a requests response so the JSON body is parsed only once.
+    All other attributes such as status_code, text and headers come from the
+    requests response.
+    """
+    def __init__(self, response):
+        self.response = response
+        self.jsonBody = None
+        self.isParsed = False
+
+    def json(self):
+        if not self.isParsed:
+            self.jsonBody = jsonLoads(self.response.content)
+            self.isParsed = True
+
+        return self.jsonBody
+
+    def __getattr__(self, name):
+        if name == 'response':
+            raise AttributeError(name)
+
+        return getattr(self.response, name)
+
+
+class SandboxHandle(Controller):
+    """
+    A sandbox handle created by Controller.sandbox().
+
+    The handle owns the per-sandbox state: sandboxName, deviceDict and blueprintChild.
+    Everything else, such as the login token, headers, the connection pool and the
+    log level, is looked up on the parent Controller so all handles share one login.
+    """
+    def __init__(self, controller, sandbox, getDeviceDetails=True):
+        """
+        Parameters
+           controller <Controller>: The logged in Controller object to share the session with.
+           sandbox <str>: The sandbox name
+           getDeviceDetails <bool>: See Controller.setSandbox()
+        """
+        self.controller = controller
+        self.sandboxName = None
+        self.blueprintChild = None
+        self.deviceDict = {}
+        self.setSandbox(sandbox, getDeviceDetails=getDeviceDetails)
+
+    def __getattr__(self, name):
+        # Only called for attributes that the handle doesn't own
+        if name == 'controller':
+            raise AttributeError(name)
+
+        return getattr(self.controller, name)
+
+    def connect(self):
+        """
+        Login again using the parent Controller so the new token is shared by all handles
+        """
+        self.controller.connect()
+
+    def getSession(self):
+        return self.controller.getSession()
+
+    def sandbox(self, sandbox, getDeviceDetails=True):
+        return self.controller.sandbox(sandbox, getDeviceDetails=getDeviceDetails)
 
 
 class SdloAssistantException(Exception):
     def __init__(self, msg=None):
+        import platform
+
         if platform.python_version().startswith('3'):
             super().__init__(msg)
 
@@ -958,8 +2398,6 @@ class SdloAssistantException(Exception):
 
         showErrorMsg = '\nsdloAssistant Exception error: {}\n\n'.format(msg)
         print(showErrorMsg)
-
-        with open(Controller.logFile, 'a') as sdlLogFile:
-            sdlLogFile.write(showErrorMsg)
+        Controller.writeLogFile(showErrorMsg)
 
     
\ No newline at end of file
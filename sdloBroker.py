@@ -0,0 +1,381 @@
+"""
+sdloBroker.py
+
+A local broker daemon that keeps logged in Tokalabs controller sessions, their connection
+pools and the device details of the sandboxes warm. Short-lived scripts ask the broker
+over a Unix socket instead of logging in and reading the sandbox devices every time.
+
+The broker uses one sdloAssistant.Controller for each controller and login, and one
+sandbox handle for each sandbox. See Controller.sandbox().
+
+Request protocol:
+   One JSON object per line. The response is one JSON object per line.
+   A connection can send many requests.
+
+   Request:
+      {"action": "getDeviceIp", "controllerIp": "10.10.10.2", "user": "admin", "password": "admin",
+       "sandbox": "testbed_1", "args": {"deviceName": "IxNetworkAPIServer"}}
+
+   Response:
+      {"status": "success", "result": "10.10.10.20"}
+      {"status": "failed", "error": "<error message>"}
+
+   Actions:
+      reserve:            args: forceTakeOwnership. Waits until the sandbox is available
+                          or the client disconnects.
+      release:            args: None
+      refresh:            Read the sandbox reservation and device details again.
+      getDeviceIp:        args: deviceName, mgmtInterfaceIndex
+      getDevicePorts:     args: srcDeviceName, targetDeviceName, isSrcDeviceIxia
+      getSandboxKeywords: args: executionProfile
+      status:             The controllers and sandboxes in the broker. No login details needed.
+      ping:               No login details needed.
+
+Requirements
+   - Python 3.7
+   - A platform with Unix sockets
+   - sdloAssistant.py
+
+Usage:
+   # Start the broker
+   python sdloBroker.py -socket /tmp/sdloBroker.sock
+
+   # From a script
+   import sdloBroker
+   broker = sdloBroker.BrokerClient('/tmp/sdloBroker.sock')
+   ip = broker.send('getDeviceIp', controllerIp, user, password, sandbox, deviceName='IxNetworkAPIServer')
+
+   # reserveSandbox.py
+   python reserveSandbox.py -sandbox testbed_1.yml -reserve -broker /tmp/sdloBroker.sock
+"""
+
+import os, json, socket, socketserver, tempfile, threading
+
+defaultSocketPath = os.path.join(tempfile.gettempdir(), 'sdloBroker-{}.sock'.format(os.getuid()))
+
+# The sandbox handle functions that the broker serves and their allowed args
+sandboxActions = {'reserve': ['forceTakeOwnership'],
+                  'release': [],
+                  'getDeviceIp': ['deviceName', 'mgmtInterfaceIndex'],
+                  'getDevicePorts': ['srcDeviceName', 'targetDeviceName', 'isSrcDeviceIxia'],
+                  'getSandboxKeywords': ['executionProfile']}
+
+
+class Broker:
+    def __init__(self, socketPath=defaultSocketPath, logLevel='info', poolSize=10, waitInterval=3):
+        """
+        Parameters
+           socketPath <str>: The Unix socket file to listen on.
+           logLevel <str>: info|debug: The log level of the Controller objects.
+           poolSize <int>: The connection pool size of each Controller.
+           waitInterval <int>: Seconds between checks while a reserve request waits for its sandbox.
+        """
+        self.socketPath = socketPath
+        self.logLevel = logLevel
+        self.poolSize = poolSize
+        self.waitInterval = waitInterval
+        # {(controllerIp, user, password): Controller}
+        self.controllers = {}
+        # {(controllerIp, user, password, sandbox): threading.Lock}
+        self.sandboxLocks = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def getController(self, controllerIp, user, password):
+        """
+        Get the Controller for a controller and login. It is created on first use.
+        """
+        import sdloAssistant
+
+        key = (controllerIp, user, password)
+        with self.lock:
+            if key not in self.controllers:
+                self.controllers[key] = sdloAssistant.Controller(controllerIp, user, password,
+                                                                 logLevel=self.logLevel, poolSize=self.poolSize)
+
+            return self.controllers[key]
+
+    def getSandboxLock(self, controllerIp, user, password, sandbox):
+        """
+        Requests for the same sandbox are run one at a time.
+        A reserve request doesn't hold the lock while it waits for the sandbox. See reserve().
+        """
+        with self.lock:
+            return self.sandboxLocks.setdefault((controllerIp, user, password, sandbox), threading.Lock())
+
+    def handleRequest(self, request, isClientConnected=None):
+        """
+        Run one request
+
+        Parameters
+           request <dict>: The request. See the request protocol in the module docstring.
+           isClientConnected <None|function>: Returns False when the client that sent the request
+                                              is gone. A reserve request stops waiting then.
+
+        Return
+           The response dict
+        """
+        action = request.get('action')
+
+        if action == 'ping':
+            return {'status': 'success', 'result': 'pong'}
+
+        if action == 'status':
+            with self.lock:
+                controllers = list(self.controllers.items())
+
+            result = [{'controllerIp': controllerIp, 'user': user,
+                       'sandboxes': {name: {'blueprintChild': handle.blueprintChild,
+                                            'devices': len(handle.deviceDict)}
+                                     for name, handle in list(controller.sandboxHandles.items())}}
+                      for (controllerIp, user, password), controller in controllers]
+            return {'status': 'success', 'result': result}
+
+        if action not in sandboxActions and action != 'refresh':
+            return {'status': 'failed', 'error': 'Unknown action: {}'.format(action)}
+
+        for key in ['controllerIp', 'user', 'password', 'sandbox']:
+            if not request.get(key):
+                return {'status': 'failed', 'error': 'Missing request parameter: {}'.format(key)}
+
+        args = request.get('args') or {}
+        unknownArgs = [arg for arg in args if arg not in sandboxActions.get(action, [])]
+        if unknownArgs:
+            return {'status': 'failed', 'error': 'Unknown args for {}: {}'.format(action, unknownArgs)}
+
+        try:
+            controller = self.getController(request['controllerIp'], request['user'], request['password'])
+            sandboxLock = self.getSandboxLock(request['controllerIp'], request['user'], request['password'],
+                                              request['sandbox'])
+
+            if action == 'reserve':
+                handle = controller.sandbox(request['sandbox'], getDeviceDetails=False)
+                return {'status': 'success', 'result': self.reserve(handle, sandboxLock,
+                                                                    isClientConnected=isClientConnected, **args)}
+
+            with sandboxLock:
+                handle = controller.sandbox(request['sandbox'])
+
+                if action == 'refresh':
+                    handle.setSandbox(request['sandbox'])
+                    return {'status': 'success', 'result': None}
+
+                return {'status': 'success', 'result': getattr(handle, action)(**args)}
+
+        except Exception as errMsg:
+            return {'status': 'failed', 'error': str(errMsg)}
+
+    def reserve(self, handle, sandboxLock, forceTakeOwnership=False, isClientConnected=None):
+        """
+        Reserve a sandbox for a client.
+
+        Waiting for a reserved sandbox is done without the sandbox lock so the release
+        and the device requests of the current owner are not blocked. The lock is only
+        held for the reserve request and reading the device details.
+
+        If the client disconnects, like a CI job that was killed or timed out, the wait is
+        stopped. A sandbox reserved after the client disconnected is released again.
+
+        Return
+           {'blueprintChild': <None|blueprint child sandbox name>}
+        """
+        import time
+        import sdloAssistant
+
+        def checkClient():
+            if isClientConnected and not isClientConnected():
+                raise BrokerException('The client disconnected while waiting for sandbox {}'.format(handle.sandboxName))
+
+        while True:
+            if not forceTakeOwnership:
+                while handle.isSandboxReserved():
+                    checkClient()
+                    time.sleep(self.waitInterval)
+
+            try:
+                with sandboxLock:
+                    checkClient()
+                    handle.reserve(forceTakeOwnership=forceTakeOwnership, wait=False)
+
+                    if isClientConnected and not isClientConnected():
+                        # Nobody is left to use or release the sandbox
+                        handle.release()
+                        raise BrokerException('The client disconnected while reserving sandbox {}. It was released.'.format(
+                            handle.sandboxName))
+
+                    return {'blueprintChild': handle.blueprintChild}
+
+            except sdloAssistant.SdloAssistantException:
+                # Another client reserved it first. Wait for it again.
+                if forceTakeOwnership or not handle.isSandboxReserved():
+                    raise
+
+    def serve(self):
+        """
+        Listen on the Unix socket until stopped with shutdown() or Ctrl-C
+        """
+        broker = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def isClientConnected(self):
+                """
+                Peek at the socket without blocking. An empty read means the client closed it.
+                """
+                try:
+                    return self.connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+                except BlockingIOError:
+                    return True
+                except OSError:
+                    return False
+
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+
+                    try:
+                        request = json.loads(line)
+                    except ValueError as errMsg:
+                        response = {'status': 'failed', 'error': 'Bad request: {}'.format(errMsg)}
+                    else:
+                        response = broker.handleRequest(request, isClientConnected=self.isClientConnected)
+
+                    try:
+                        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                        self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        # The client is gone. Nobody to send the response to.
+                        return
+
+        if os.path.exists(self.socketPath):
+            # Remove a socket file left over by a broker that didn't shut down cleanly
+            if BrokerClient(self.socketPath).isAlive():
+                raise Exception('A broker is already listening on {}'.format(self.socketPath))
+
+            os.remove(self.socketPath)
+
+        # Only the user running the broker can connect to it
+        oldUmask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socketPath, RequestHandler)
+        finally:
+            os.umask(oldUmask)
+
+        self.server.daemon_threads = True
+        print('\nsdloBroker listening on: {}\n'.format(self.socketPath))
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+
+
+class BrokerClient:
+    """
+    Send requests to a running sdloBroker.
+    Only uses the standard library so scripts that use the broker start fast.
+    """
+    def __init__(self, socketPath=defaultSocketPath, timeout=None):
+        """
+        Parameters
+           socketPath <str>: The Unix socket file of the broker.
+           timeout <None|int>: Socket timeout in seconds. None = wait forever.
+                               Keep None for reserve since it waits for the sandbox to be available.
+        """
+        self.socketPath = socketPath
+        self.timeout = timeout
+        self.sock = None
+        self.sockFile = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+        self.sockFile = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock:
+            self.sockFile.close()
+            self.sock.close()
+            self.sock = None
+            self.sockFile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, request):
+        """
+        Send a request dict and return the response dict
+        """
+        if self.sock is None:
+            self.open()
+
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self.sockFile.readline()
+        if not line:
+            self.close()
+            raise BrokerException('The broker closed the connection')
+
+        return json.loads(line)
+
+    def send(self, action, controllerIp, user, password, sandbox, **args):
+        """
+        Run a sandbox action in the broker
+
+        Usage example:
+           broker.send('reserve', controllerIp, user, password, 'testbed_1', forceTakeOwnership=True)
+
+        Return
+           The result of the action. Raises BrokerException if the action failed.
+        """
+        response = self.request({'action': action, 'controllerIp': controllerIp, 'user': user,
+                                 'password': password, 'sandbox': sandbox, 'args': args})
+
+        if response['status'] != 'success':
+            raise BrokerException('{} {}: {}'.format(action, sandbox, response['error']))
+
+        return response['result']
+
+    def isAlive(self):
+        """
+        Return True if a broker answers on the socket
+        """
+        try:
+            return self.request({'action': 'ping'})['status'] == 'success'
+        except (OSError, ValueError, BrokerException):
+            return False
+        finally:
+            self.close()
+
+
+class BrokerException(Exception):
+    pass
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-socket', default=defaultSocketPath, help='The Unix socket file to listen on')
+    parser.add_argument('-logLevel', default='info', choices=['info', 'debug'], help='The Controller log level')
+    parser.add_argument('-poolSize', type=int, default=10, help='The connection pool size for each controller')
+    args = parser.parse_args()
+
+    broker = Broker(args.socket, logLevel=args.logLevel, poolSize=args.poolSize)
+    try:
+        broker.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
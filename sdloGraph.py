@@ -0,0 +1,316 @@
+"""
+sdloGraph.py
+
+Export the port connections of all the devices and vLinks in the inventory as one graph
+and answer connectivity questions from the exported file without the controller.
+
+The nodes are the devices. The edges are the port connections, annotated with the
+source and target ports and the vLink when one end of the connection is a vLink.
+
+The devices are read one page at a time (see Controller.iterDevices()) and the nodes and
+edges are written to the file as they are read, so memory doesn't grow with the inventory.
+A connection is written once for each end that reports it. ConnectionGraph merges them.
+
+File formats:
+   jsonl:   One JSON object per line:
+            {"type": "node", "id": "switch1", "deviceType": "Switch"}
+            {"type": "edge", "source": "switch1", "sourcePort": "1/1", "target": "server1",
+             "targetPort": "eth0", "vlink": null}
+   graphml: GraphML with the same node and edge attributes.
+
+Requirements
+   - Python 3.7
+   - pip install requests PyYAML
+   - sdloAssistant.py
+
+Usage:
+   # Export. The yml config file has sdloControllerIp, user and password.
+   python sdloGraph.py -config controller.yml -export lab.jsonl
+   python sdloGraph.py -config controller.yml -export lab.graphml
+
+   # Query the exported file
+   python sdloGraph.py -graph lab.jsonl -neighbors switch1
+   python sdloGraph.py -graph lab.jsonl -links switch1 server1
+   python sdloGraph.py -graph lab.jsonl -path ixia1 server1
+
+   # From a script
+   import sdloGraph
+   sdloGraph.exportConnectionGraph(controller, 'lab.jsonl')
+   graph = sdloGraph.ConnectionGraph.load('lab.jsonl')
+   print(graph.path('ixia1', 'server1'))
+"""
+
+import os, json
+from xml.sax.saxutils import escape, quoteattr
+
+deviceFields = ['hostname', 'deviceType', 'physicalPortConnections']
+
+graphmlHeader = '''<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns">
+  <key id="deviceType" for="node" attr.name="deviceType" attr.type="string"/>
+  <key id="sourcePort" for="edge" attr.name="sourcePort" attr.type="string"/>
+  <key id="targetPort" for="edge" attr.name="targetPort" attr.type="string"/>
+  <key id="vlink" for="edge" attr.name="vlink" attr.type="string"/>
+  <graph id="tokalabs" edgedefault="undirected">
+'''
+
+graphmlFooter = '''  </graph>
+</graphml>
+'''
+
+
+def isVlink(device):
+    return 'vlink' in str(device.get('deviceType', '')).lower()
+
+def getDeviceEdges(device):
+    """
+    Get the port connections of a device as edge dicts
+    """
+    physicalPortConnections = device.get('physicalPortConnections') or {}
+    vlink = device['hostname'] if isVlink(device) else None
+
+    edges = []
+    for portDetails in physicalPortConnections.get('interfaces', []):
+        connection = portDetails.get('directConnectionDetails')
+        if not connection or not connection.get('targetHost'):
+            continue
+
+        edges.append({'type': 'edge', 'source': device['hostname'], 'sourcePort': connection.get('sourcePortId'),
+                      'target': connection['targetHost'], 'targetPort': connection.get('targetPortId'),
+                      'vlink': vlink})
+
+    return edges
+
+def exportConnectionGraph(controller, outputFile, fileFormat=None, pageSize=200):
+    """
+    Write the port connections of all the devices to a file.
+
+    Parameters
+       controller <sdloAssistant.Controller>: A Controller object
+       outputFile <str>: The file to write
+       fileFormat <None|str>: jsonl|graphml. None = from the file extension. Defaults to jsonl.
+       pageSize <int>: How many devices to read per query
+
+    Return
+       A dict: {'nodes': <number of devices>, 'edges': <number of edge records>}
+    """
+    if fileFormat is None:
+        fileFormat = 'graphml' if outputFile.endswith('.graphml') else 'jsonl'
+
+    if fileFormat not in ['jsonl', 'graphml']:
+        raise ValueError('fileFormat must be jsonl or graphml: {}'.format(fileFormat))
+
+    nodeCount = 0
+    edgeCount = 0
+    tempFile = outputFile + '.tmp'
+
+    with open(tempFile, 'w') as graphFile:
+        if fileFormat == 'graphml':
+            graphFile.write(graphmlHeader)
+
+        for device in controller.iterDevices(fieldsToFetch=deviceFields, pageSize=pageSize):
+            node = {'type': 'node', 'id': device['hostname'], 'deviceType': device.get('deviceType')}
+            edges = getDeviceEdges(device)
+
+            if fileFormat == 'jsonl':
+                graphFile.write(json.dumps(node) + '\n')
+                for edge in edges:
+                    graphFile.write(json.dumps(edge) + '\n')
+            else:
+                graphFile.write('    <node id={}><data key="deviceType">{}</data></node>\n'.format(
+                    quoteattr(node['id']), escapeText(node['deviceType'])))
+
+                for edge in edges:
+                    graphFile.write('    <edge source={} target={}>'.format(quoteattr(edge['source']),
+                                                                            quoteattr(edge['target'])))
+                    for key in ['sourcePort', 'targetPort', 'vlink']:
+                        if edge[key] is not None:
+                            graphFile.write('<data key="{}">{}</data>'.format(key, escapeText(edge[key])))
+
+                    graphFile.write('</edge>\n')
+
+            nodeCount += 1
+            edgeCount += len(edges)
+
+        if fileFormat == 'graphml':
+            graphFile.write(graphmlFooter)
+
+    os.replace(tempFile, outputFile)
+    controller.logInfo('exportConnectionGraph: {} devices, {} connections written to {}'.format(
+        nodeCount, edgeCount, outputFile))
+
+    return {'nodes': nodeCount, 'edges': edgeCount}
+
+def escapeText(value):
+    return escape(str(value)) if value is not None else ''
+
+
+class ConnectionGraph:
+    """
+    An undirected graph of the devices and their port connections loaded from a file
+    written by exportConnectionGraph().
+
+    Links reported by both ends are merged. A link is identified by its two (device, port) ends.
+    """
+    def __init__(self):
+        # {device: deviceType}
+        self.nodes = {}
+        # {device: {neighbor: {linkKey: link}}}
+        self.adjacency = {}
+
+    @classmethod
+    def load(cls, graphFile):
+        graph = cls()
+        if graphFile.endswith('.graphml'):
+            records = cls.readGraphml(graphFile)
+        else:
+            records = cls.readJsonl(graphFile)
+
+        for record in records:
+            if record['type'] == 'node':
+                graph.nodes[record['id']] = record.get('deviceType')
+                graph.adjacency.setdefault(record['id'], {})
+            else:
+                graph.addLink(record)
+
+        return graph
+
+    @staticmethod
+    def readJsonl(graphFile):
+        with open(graphFile) as graphFileObj:
+            for line in graphFileObj:
+                if line.strip():
+                    yield json.loads(line)
+
+    @staticmethod
+    def readGraphml(graphFile):
+        import xml.etree.ElementTree as ElementTree
+
+        namespace = '{http://graphml.graphdrawing.org/xmlns}'
+        for event, element in ElementTree.iterparse(graphFile):
+            data = {dataElement.get('key'): dataElement.text for dataElement in element.findall(namespace + 'data')}
+
+            if element.tag == namespace + 'node':
+                yield {'type': 'node', 'id': element.get('id'), 'deviceType': data.get('deviceType')}
+                element.clear()
+
+            elif element.tag == namespace + 'edge':
+                yield {'type': 'edge', 'source': element.get('source'), 'sourcePort': data.get('sourcePort'),
+                       'target': element.get('target'), 'targetPort': data.get('targetPort'),
+                       'vlink': data.get('vlink')}
+                element.clear()
+
+    def addLink(self, edge):
+        source, target = edge['source'], edge['target']
+        ends = sorted([(source, edge.get('sourcePort') or ''), (target, edge.get('targetPort') or '')])
+        linkKey = tuple(ends)
+
+        for device in [source, target]:
+            self.nodes.setdefault(device, None)
+            self.adjacency.setdefault(device, {})
+
+        links = self.adjacency[source].setdefault(target, {})
+        link = links.get(linkKey)
+        if link is None:
+            link = {'ends': [list(end) for end in ends], 'vlink': edge.get('vlink')}
+            links[linkKey] = link
+            # Both directions share the same link dict
+            self.adjacency[target].setdefault(source, {})[linkKey] = link
+        elif link['vlink'] is None:
+            link['vlink'] = edge.get('vlink')
+
+    def neighbors(self, device):
+        """
+        Return the sorted list of devices connected to a device
+        """
+        return sorted(self.adjacency.get(device, {}))
+
+    def links(self, deviceA, deviceB):
+        """
+        Return the links between two devices:
+           [{'ends': [[device, port], [device, port]], 'vlink': None|vLinkName}]
+        """
+        return list(self.adjacency.get(deviceA, {}).get(deviceB, {}).values())
+
+    def path(self, source, target):
+        """
+        Find the shortest device path between two devices
+
+        Return
+           A list of devices from source to target | None if they are not connected
+        """
+        from collections import deque
+
+        if source not in self.adjacency or target not in self.adjacency:
+            return None
+
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            device = queue.popleft()
+            if device == target:
+                path = []
+                while device is not None:
+                    path.append(device)
+                    device = previous[device]
+
+                return list(reversed(path))
+
+            for neighbor in self.adjacency[device]:
+                if neighbor not in previous:
+                    previous[neighbor] = device
+                    queue.append(neighbor)
+
+        return None
+
+    def isConnected(self, deviceA, deviceB):
+        return self.path(deviceA, deviceB) is not None
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', help='For -export. A yml file with sdloControllerIp, user and password')
+    parser.add_argument('-export', help='Export the connection graph to this .jsonl or .graphml file')
+    parser.add_argument('-pageSize', type=int, default=200, help='For -export. Devices per query')
+    parser.add_argument('-graph', help='Query this exported .jsonl or .graphml file')
+    parser.add_argument('-neighbors', metavar='DEVICE', help='List the devices connected to a device')
+    parser.add_argument('-links', nargs=2, metavar='DEVICE', help='List the links between two devices')
+    parser.add_argument('-path', nargs=2, metavar='DEVICE', help='Find a path between two devices')
+    args = parser.parse_args()
+
+    if args.export:
+        if not args.config:
+            parser.error('-export needs -config')
+
+        import yaml
+        import sdloAssistant
+
+        with open(args.config) as configFile:
+            params = yaml.safe_load(configFile)
+
+        controller = sdloAssistant.Controller(params['sdloControllerIp'], params['user'], params['password'],
+                                              logLevel='info')
+        print(json.dumps(exportConnectionGraph(controller, args.export, pageSize=args.pageSize)))
+        return
+
+    if not args.graph:
+        parser.error('Include -export or -graph')
+
+    graph = ConnectionGraph.load(args.graph)
+    if args.neighbors:
+        result = graph.neighbors(args.neighbors)
+    elif args.links:
+        result = graph.links(*args.links)
+    elif args.path:
+        result = graph.path(*args.path)
+    else:
+        result = {'nodes': len(graph.nodes),
+                  'links': sum(len(links) for neighbors in graph.adjacency.values() for links in neighbors.values()) // 2}
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
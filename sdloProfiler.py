@@ -0,0 +1,102 @@
+"""
+sdloProfiler.py
+
+Profile a script that uses sdloAssistant and write the results for flame graphs.
+
+Two files are written:
+   <outputFile>            cProfile stats of the main thread. Open with pstats, snakeviz, gprof2dot, ...
+   <outputFile>.collapsed  Sampled stacks of all the threads in the collapsed stack format
+                           (frame;frame;frame count) used by flamegraph.pl and speedscope.
+                           Use this for the work done in thread pools.
+
+Only one cProfile profiler is enabled. On Python 3.12+ cProfile uses sys.monitoring,
+which allows one active profiler at a time, so the threads are not profiled separately.
+
+Requirements
+   - Python 3.7
+
+Usage:
+   import sdloProfiler
+
+   with sdloProfiler.Profiler('/tmp/reserve.pstats'):
+       main()
+
+   python -m pstats /tmp/reserve.pstats
+   flamegraph.pl /tmp/reserve.pstats.collapsed > reserve.svg
+"""
+
+import os, sys, time, threading
+
+
+class Profiler:
+    def __init__(self, outputFile, sampleInterval=0.005):
+        """
+        Parameters
+           outputFile <str>: The cProfile stats file. The collapsed stacks are written to <outputFile>.collapsed
+           sampleInterval <float>: Seconds between stack samples
+        """
+        import cProfile
+
+        self.outputFile = outputFile
+        self.collapsedFile = outputFile + '.collapsed'
+        self.sampleInterval = sampleInterval
+        self.profile = cProfile.Profile()
+        # {collapsed stack: sample count}
+        self.stacks = {}
+        self.isRunning = threading.Event()
+        self.sampler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.isRunning.set()
+        self.sampler = threading.Thread(target=self.sample, name='sdloProfilerSampler', daemon=True)
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.isRunning.clear()
+        self.sampler.join()
+        self.write()
+
+    def sample(self):
+        """
+        Record the stacks of all the threads every sampleInterval seconds
+        """
+        samplerId = threading.get_ident()
+
+        while self.isRunning.is_set():
+            for threadId, frame in sys._current_frames().items():
+                if threadId == samplerId:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+
+                collapsed = ';'.join(reversed(stack))
+                self.stacks[collapsed] = self.stacks.get(collapsed, 0) + 1
+
+            time.sleep(self.sampleInterval)
+
+    def write(self):
+        import pstats
+
+        stats = pstats.Stats(self.profile)
+        stats.dump_stats(self.outputFile)
+
+        with open(self.collapsedFile, 'w') as collapsedFileObj:
+            for stack, count in sorted(self.stacks.items()):
+                collapsedFileObj.write('{} {}\n'.format(stack, count))
+
+        print('\nProfile written to: {}\nCollapsed stacks written to: {}\n'.format(self.outputFile,
+                                                                                 self.collapsedFile))
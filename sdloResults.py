@@ -0,0 +1,267 @@
+"""
+sdloResults.py
+
+A local results history in an embedded SQLite database.
+
+Controller.getResults() and showResults() only see the latest run of a sandbox.
+The ResultsStore collects the counters of each run with the sandbox, suite and timestamps
+so dashboards can query pass rates and slow suites locally instead of polling the controller.
+
+Writes are buffered and written in batches. The database uses WAL mode so readers
+are not blocked while results are collected.
+
+Requirements
+   - Python 3.7
+   - sdloAssistant.py
+
+Usage:
+   import sdloAssistant, sdloResults
+
+   store = sdloResults.ResultsStore('/path/results.db')
+   sandboxObj = controller.sandbox('testbed_1')
+
+   startTime = time.time()
+   sandboxObj.runSuite('regression')
+   sandboxObj.waitForCompletion('regression')
+   store.collect(sandboxObj, suiteName='regression', startTime=startTime, endTime=time.time())
+
+   store.flush()
+   print(store.passRatePerDay(sandbox='testbed_1'))
+   print(store.slowestSuites(limit=5))
+   store.close()
+
+   # Command line
+   python sdloResults.py -db /path/results.db -passRate
+   python sdloResults.py -db /path/results.db -slowest 10
+"""
+
+import os, time, sqlite3, threading
+
+schema = '''
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    controller TEXT,
+    sandbox TEXT NOT NULL,
+    suite TEXT,
+    status TEXT,
+    total INTEGER,
+    casesPassed INTEGER,
+    casesFailed INTEGER,
+    stepsPassed INTEGER,
+    stepsFailed INTEGER,
+    startTime REAL,
+    endTime REAL,
+    collectedTime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resultsSandboxTime ON results (sandbox, collectedTime);
+CREATE INDEX IF NOT EXISTS resultsSuiteTime ON results (suite, collectedTime);
+CREATE INDEX IF NOT EXISTS resultsTime ON results (collectedTime);
+'''
+
+columns = ['controller', 'sandbox', 'suite', 'status', 'total', 'casesPassed', 'casesFailed',
+           'stepsPassed', 'stepsFailed', 'startTime', 'endTime', 'collectedTime']
+
+counters = ['total', 'casesPassed', 'casesFailed', 'stepsPassed', 'stepsFailed']
+
+
+class ResultsStore:
+    def __init__(self, dbFile='sdloResults.db', batchSize=100, flushInterval=10):
+        """
+        Parameters
+           dbFile <str>: The SQLite database file. It is created if it doesn't exist.
+           batchSize <int>: Write the buffered results when this many are waiting.
+           flushInterval <int>: Write the buffered results when the oldest one has waited
+                                this many seconds. Checked when a result is added.
+        """
+        self.dbFile = dbFile
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.buffer = []
+        self.bufferStartTime = None
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(dbFile, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, sandbox, results, suiteName=None, startTime=None, endTime=None, controller=None):
+        """
+        Buffer the results of one run.
+
+        Parameters
+           sandbox <str>: The sandbox name
+           results <dict>: The results from Controller.getLatestResults():
+                           {'testStatus': 'Completed', 'total': '5', 'casesPassed': '4', 'casesFailed': '1',
+                            'stepsPassed': '3', 'stepsFailed': '0'}
+           suiteName <None|str>: The suite that was run
+           startTime, endTime <None|float>: Epoch seconds of the run
+           controller <None|str>: The controller IP
+        """
+        row = {'controller': controller, 'sandbox': sandbox, 'suite': suiteName,
+               'status': results.get('testStatus'), 'startTime': startTime, 'endTime': endTime,
+               'collectedTime': time.time()}
+
+        for counter in counters:
+            value = results.get(counter)
+            row[counter] = int(value) if value not in [None, ''] else None
+
+        with self.lock:
+            if not self.buffer:
+                self.bufferStartTime = time.time()
+
+            self.buffer.append(tuple(row[column] for column in columns))
+            isFull = len(self.buffer) >= self.batchSize or time.time() - self.bufferStartTime >= self.flushInterval
+
+        if isFull:
+            self.flush()
+
+    def collect(self, sandboxObj, suiteName=None, startTime=None, endTime=None):
+        """
+        Get the latest results of a sandbox from the controller and buffer them.
+
+        Parameters
+           sandboxObj <Controller|SandboxHandle>: The sandbox to collect the results of
+           suiteName <None|str>: The suite that was run
+           startTime, endTime <None|float>: Epoch seconds of the run
+
+        Return
+           The results dict
+        """
+        results = sandboxObj.getLatestResults()
+        self.add(sandboxObj.sandboxName, results, suiteName=suiteName, startTime=startTime, endTime=endTime,
+                 controller=sandboxObj.controllerIp)
+        return results
+
+    def flush(self):
+        """
+        Write the buffered results in one transaction
+        """
+        with self.lock:
+            if not self.buffer:
+                return
+
+            with self.db:
+                self.db.executemany('INSERT INTO results ({}) VALUES ({})'.format(
+                    ','.join(columns), ','.join('?' * len(columns))), self.buffer)
+
+            self.buffer = []
+            self.bufferStartTime = None
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def query(self, sql, params=()):
+        """
+        Run a query and return a list of dicts. Buffered results are not included until flush().
+        """
+        with self.lock:
+            return [dict(row) for row in self.db.execute(sql, params)]
+
+    def passRatePerDay(self, sandbox=None, since=None):
+        """
+        Get the pass rate of each sandbox for each day.
+        A run passed if no cases and no steps failed.
+
+        Parameters
+           sandbox <None|str>: Only this sandbox
+           since <None|float>: Epoch seconds. Only runs collected since this time.
+
+        Return
+           [{'sandbox': 'testbed_1', 'day': '2021-03-29', 'runs': 10, 'passedRuns': 9, 'passRate': 0.9,
+             'casesPassed': 48, 'casesTotal': 50}]
+        """
+        where, params = self.filters(sandbox=sandbox, since=since)
+        return self.query('''
+            SELECT sandbox, date(collectedTime, 'unixepoch') AS day, COUNT(*) AS runs,
+                   SUM(casesFailed = 0 AND stepsFailed = 0) AS passedRuns,
+                   ROUND(1.0 * SUM(casesFailed = 0 AND stepsFailed = 0) / COUNT(*), 4) AS passRate,
+                   SUM(casesPassed) AS casesPassed, SUM(total) AS casesTotal
+            FROM results {}
+            GROUP BY sandbox, day
+            ORDER BY sandbox, day'''.format(where), params)
+
+    def slowestSuites(self, limit=10, sandbox=None, since=None):
+        """
+        Get the suites with the longest average run time.
+        Only runs collected with a startTime and an endTime are included.
+
+        Return
+           [{'suite': 'regression', 'runs': 10, 'avgDuration': 3600.0, 'maxDuration': 4000.0}]
+        """
+        where, params = self.filters(sandbox=sandbox, since=since, extra=['startTime IS NOT NULL',
+                                                                          'endTime IS NOT NULL'])
+        return self.query('''
+            SELECT suite, COUNT(*) AS runs, AVG(endTime - startTime) AS avgDuration,
+                   MAX(endTime - startTime) AS maxDuration
+            FROM results {}
+            GROUP BY suite
+            ORDER BY avgDuration DESC
+            LIMIT ?'''.format(where), params + [limit])
+
+    def history(self, sandbox=None, suiteName=None, since=None, limit=100):
+        """
+        Get the latest runs, newest first
+        """
+        where, params = self.filters(sandbox=sandbox, suiteName=suiteName, since=since)
+        return self.query('SELECT * FROM results {} ORDER BY collectedTime DESC LIMIT ?'.format(where),
+                          params + [limit])
+
+    def filters(self, sandbox=None, suiteName=None, since=None, extra=None):
+        conditions = list(extra or [])
+        params = []
+
+        if sandbox is not None:
+            conditions.append('sandbox = ?')
+            params.append(sandbox)
+
+        if suiteName is not None:
+            conditions.append('suite = ?')
+            params.append(suiteName)
+
+        if since is not None:
+            conditions.append('collectedTime >= ?')
+            params.append(since)
+
+        if not conditions:
+            return '', params
+
+        return 'WHERE ' + ' AND '.join(conditions), params
+
+
+def main():
+    import argparse, json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-db', required=True, help='The results database file')
+    parser.add_argument('-sandbox', default=None, help='Only this sandbox')
+    parser.add_argument('-days', type=int, default=None, help='Only the last number of days')
+    parser.add_argument('-passRate', action='store_true', help='Show the pass rate per sandbox per day')
+    parser.add_argument('-slowest', type=int, default=None, help='Show this many of the slowest suites')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error('No such results database: {}'.format(args.db))
+
+    since = time.time() - args.days * 86400 if args.days else None
+
+    with ResultsStore(args.db) as store:
+        if args.slowest:
+            rows = store.slowestSuites(limit=args.slowest, sandbox=args.sandbox, since=since)
+        elif args.passRate:
+            rows = store.passRatePerDay(sandbox=args.sandbox, since=since)
+        else:
+            rows = store.history(sandbox=args.sandbox, since=since)
+
+    print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Simulate CI jobs competing for a pool of sandboxes to find how many parallel jobs a pool
+supports before the reservation wait times grow without bound.
+
+Each job is a separate sdloAssistant.Controller, like a CI job in its own process.
+A job arrives, picks a random sandbox of the pool, waits for it with reserve(), holds it
+for the job duration and releases it. The Controllers talk to a local in-process stand-in
+for the login, topologies, reserve and release endpoints of the Tokalabs controller.
+
+Two jobs that see the same sandbox become available can both ask to reserve it. The
+stand-in reserves it for the first one and tells the other that it is already reserved,
+like the controller does. The job then goes back to waiting with reserve(). These are
+counted as conflicts.
+
+Simulated time runs -speedup times faster than real time. Job durations, arrivals and
+the reserve() wait intervals are scaled. The response time of the stand-in is not, so use
+a speedup that keeps the scaled wait intervals well above a millisecond.
+
+Reported for each arrival rate and pool size:
+   - The reservation latency percentiles: from the job arrival to the sandbox being reserved.
+   - The controller request rate per simulated minute and the requests by endpoint.
+   - The sandbox utilisation: the share of the time the sandboxes were reserved.
+
+Requirements
+   - python 3.7
+   - pip install requests
+   - sdloAssistant.py
+
+Usage:
+   # 200 jobs of 20 minutes on average, 4 jobs per minute, 100 sandboxes
+   python simulateReservations.py -jobs 200 -jobDuration 20 -arrivalRate 4 -pool 100
+
+   # Find the arrival rate where queueing takes off on a pool of 50 sandboxes
+   python simulateReservations.py -jobDuration 20 -arrivalRate 1 2 2.5 3 -pool 50
+
+   # Compare the default fixed 3 second polling with backoff and jitter
+   python simulateReservations.py -arrivalRate 3 -pool 50 -waitInterval 5 -backoff 2 -maxWaitInterval 60 -jitter 0.2
+"""
+
+import os, re, json, math, time, random, argparse, threading, contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sdloAssistant
+
+class ControllerStandIn:
+    """
+    A local stand-in for the login, topologies, reserve and release endpoints
+    of the Tokalabs controller. Counts the requests and the reserved time of each sandbox.
+    """
+    def __init__(self, sandboxes, responseTime=0):
+        """
+        Parameters
+           sandboxes <list>: The sandbox names of the pool
+           responseTime <float>: Real seconds added to each response to mimic the controller
+        """
+        self.responseTime = responseTime
+        self.lock = threading.Lock()
+        # {sandbox: user | None}
+        self.owners = {sandbox: None for sandbox in sandboxes}
+        # {sandbox: reserve time}
+        self.reserveTimes = {}
+        # {sandbox: reserved seconds}
+        self.reservedTime = {sandbox: 0.0 for sandbox in sandboxes}
+        # {endpoint: count}
+        self.requests = {}
+        self.server = None
+
+    def start(self):
+        standIn = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond(standIn.handleRequest('get', self.path))
+
+            def do_POST(self):
+                self.respond(standIn.handleRequest('post', self.path))
+
+            def respond(self, body):
+                # Read the JSON payload so the connection can be reused
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if standIn.responseTime:
+                    time.sleep(standIn.responseTime)
+
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def handleRequest(self, verb, path):
+        from urllib.parse import urlsplit, parse_qs, unquote
+
+        url = urlsplit(path)
+
+        if verb == 'post' and url.path == '/tokalabs/api/login':
+            self.count('login')
+            return {'status': 'Success', 'additionalDetails': {'token': {'token': 'ci/{:x}'.format(random.getrandbits(64))}}}
+
+        if url.path == '/tokalabs/api/topologies':
+            self.count('topologies')
+            query = parse_qs(url.query)
+            namePattern = query['name'][0] if 'name' in query else ''
+            with self.lock:
+                topologies = [{'name': sandbox, 'type': 'regular', 'devices': [],
+                               'reservationDetails': {'reservationStatus': 'reserved' if owner else 'available',
+                                                      'reservedBy': owner}}
+                              for sandbox, owner in self.owners.items() if re.search(namePattern, sandbox)]
+
+            return {'status': 'Success', 'additionalDetails': {'topologiesList': topologies}}
+
+        match = re.match('/tokalabs/api/topology/(.+)/(reserve|release)/user=(.+)/token=', url.path)
+        if match:
+            sandbox, action, user = unquote(match.group(1)), match.group(2), match.group(3)
+            self.count(action)
+
+            with self.lock:
+                if sandbox not in self.owners:
+                    return {'status': 'Failed', 'message': 'No such sandbox: {}'.format(sandbox)}
+
+                if action == 'reserve':
+                    if self.owners[sandbox]:
+                        return {'status': 'Sandbox is already reserved', 'message': self.owners[sandbox]}
+
+                    self.owners[sandbox] = user
+                    self.reserveTimes[sandbox] = time.perf_counter()
+                    return {'status': 'Sandbox Reserved Successfully', 'TopologyName': sandbox}
+
+                if self.owners[sandbox]:
+                    self.reservedTime[sandbox] += time.perf_counter() - self.reserveTimes.pop(sandbox)
+
+                self.owners[sandbox] = None
+                return {'status': 'Sandbox Released Successfully', 'message': ''}
+
+        self.count('unknown')
+        return {'status': 'Failed', 'message': 'Unknown request: {} {}'.format(verb, path)}
+
+
+def percentile(values, percent):
+    """
+    The nearest-rank percentile of a list of numbers
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def runJob(controllerAddress, jobNumber, sandbox, duration, args, results):
+    """
+    Reserve a sandbox, hold it for the job duration and release it
+
+    Parameters
+       duration <float>: The job duration in real seconds
+       results <dict>: The results of the job are added to this dict
+    """
+    arrivalTime = time.perf_counter()
+    results.update({'sandbox': sandbox, 'conflicts': 0, 'latency': None, 'error': None})
+
+    try:
+        # A Controller per job like a CI job in its own process. No state file so the
+        # simulation doesn't touch the reservations of the user.
+        controller = sdloAssistant.Controller(controllerAddress, 'ci-{}'.format(jobNumber), 'password',
+                                              logLevel='info', poolSize=1, stateFile=None, protocol='http')
+        sandboxObj = controller.sandbox(sandbox, getDeviceDetails=False)
+
+        while True:
+            try:
+                sandboxObj.reserve(waitInterval=args.waitInterval / args.speedup, backoff=args.backoff,
+                                   maxWaitInterval=args.maxWaitInterval / args.speedup, jitter=args.jitter)
+                break
+            except sdloAssistant.SdloAssistantException as errMsg:
+                if 'already reserved' not in str(errMsg):
+                    raise
+
+                results['conflicts'] += 1
+
+        results['latency'] = (time.perf_counter() - arrivalTime) * args.speedup
+        time.sleep(duration)
+        sandboxObj.release()
+
+    except Exception as errMsg:
+        results['error'] = str(errMsg)
+
+def simulate(arrivalRate, poolSize, args):
+    """
+    Run one simulation
+
+    Parameters
+       arrivalRate <float>: Jobs per simulated minute
+       poolSize <int>: How many sandboxes are in the pool
+
+    Return
+       The report dict
+    """
+    randomGen = random.Random(args.seed)
+    sandboxes = ['simSandbox{}'.format(number) for number in range(poolSize)]
+    standIn = ControllerStandIn(sandboxes, responseTime=args.responseTime)
+    controllerAddress = standIn.start()
+
+    jobs = []
+    startTime = time.perf_counter()
+    try:
+        nextArrival = startTime
+        for jobNumber in range(args.jobs):
+            # Poisson arrivals
+            nextArrival += randomGen.expovariate(arrivalRate) * 60 / args.speedup
+            time.sleep(max(nextArrival - time.perf_counter(), 0))
+
+            if args.durationDistribution == 'exponential':
+                duration = randomGen.expovariate(1.0 / args.jobDuration)
+            else:
+                duration = args.jobDuration
+
+            results = {}
+            job = threading.Thread(target=runJob, args=(controllerAddress, jobNumber, randomGen.choice(sandboxes),
+                                                        duration * 60 / args.speedup, args, results), daemon=True)
+            job.start()
+            jobs.append((job, results))
+
+        for job, results in jobs:
+            job.join()
+
+    finally:
+        elapsed = time.perf_counter() - startTime
+        standIn.stop()
+
+    simulatedMinutes = elapsed * args.speedup / 60
+    latencies = [results['latency'] for job, results in jobs if results['latency'] is not None]
+    requests = sum(standIn.requests.values())
+
+    return {'arrivalRate': arrivalRate,
+            'pool': poolSize,
+            'jobs': len(jobs),
+            'failed': len([results for job, results in jobs if results['error']]),
+            'errors': sorted(set(results['error'] for job, results in jobs if results['error']))[:5],
+            'conflicts': sum(results['conflicts'] for job, results in jobs),
+            'simulatedMinutes': round(simulatedMinutes, 1),
+            'latencySeconds': {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+                               'p99': percentile(latencies, 99), 'max': max(latencies) if latencies else None,
+                               'mean': sum(latencies) / len(latencies) if latencies else None},
+            'requests': requests,
+            'requestsPerMinute': round(requests / simulatedMinutes, 1) if simulatedMinutes else None,
+            'requestsByEndpoint': standIn.requests,
+            'utilisation': round(sum(standIn.reservedTime.values()) / (elapsed * poolSize), 3)}
+
+def roundLatencies(report):
+    for key, value in report['latencySeconds'].items():
+        if value is not None:
+            report['latencySeconds'][key] = round(value, 1)
+
+    return report
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-jobs', type=int, default=200, help='How many jobs to run in each simulation')
+    parser.add_argument('-jobDuration', type=float, default=20, help='The mean job duration in minutes')
+    parser.add_argument('-durationDistribution', default='exponential', choices=['exponential', 'fixed'],
+                        help='How the job durations are distributed')
+    parser.add_argument('-arrivalRate', type=float, nargs='+', default=[2.0],
+                        help='Jobs per minute. Pass in multiple rates to compare them.')
+    parser.add_argument('-pool', type=int, nargs='+', default=[50],
+                        help='How many sandboxes are in the pool. Pass in multiple sizes to compare them.')
+    parser.add_argument('-waitInterval', type=float, default=3, help='reserve() seconds between checks')
+    parser.add_argument('-backoff', type=float, default=1, help='reserve() wait multiplier after each check')
+    parser.add_argument('-maxWaitInterval', type=float, default=60, help='reserve() longest wait between checks')
+    parser.add_argument('-jitter', type=float, default=0, help='reserve() wait randomization. 0-1.')
+    parser.add_argument('-speedup', type=float, default=120,
+                        help='Simulated seconds per real second. Defaults to 120: a simulated hour takes 30 seconds.')
+    parser.add_argument('-responseTime', type=float, default=0,
+                        help='Real seconds the stand-in waits before each response')
+    parser.add_argument('-seed', type=int, default=1, help='The random seed of the arrivals, durations and sandboxes')
+    parser.add_argument('-summary', default=None, help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.jobs < 1 or args.speedup <= 0 or not 0 <= args.jitter <= 1:
+        parser.error('-jobs must be 1 or more, -speedup more than 0 and -jitter 0-1')
+
+    # Keep the Controller log messages of the simulated jobs off stdout and out of sdloAssistant.log
+    sdloAssistant.Controller.logFile = os.devnull
+
+    reports = []
+    for poolSize in args.pool:
+        for arrivalRate in args.arrivalRate:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                report = roundLatencies(simulate(arrivalRate, poolSize, args))
+
+            reports.append(report)
+            latency = report['latencySeconds']
+            print('pool {:>4}  arrivalRate {:>6}/min  latency p50 {}s p90 {}s p99 {}s  requests {}/min  '
+                  'utilisation {:.0%}  conflicts {}  failed {}'.format(
+                      poolSize, arrivalRate, latency['p50'], latency['p90'], latency['p99'],
+                      report['requestsPerMinute'], report['utilisation'], report['conflicts'], report['failed']))
+
+    reportJson = json.dumps(reports, indent=2)
+    if args.summary:
+        with open(args.summary, 'w') as summaryFile:
+            summaryFile.write(reportJson + '\n')
+
+    print('\nsimulateReservations.py report:\n{}\n'.format(reportJson))
+
+
+if __name__ == '__main__':
+    main()